@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import datetime as dt
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple, Union
+
+from config import BACKUP_CHUNK_SIZE, BACKUP_COMICS_WORKERS
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class BackupError(Exception):
+    pass
+
+
+def create_snapshot(db_file_name: Union[str, Path], snapshot_file_name: Path) -> int:
+    """
+    Согласованный снимок базы через online backup API SQLite. Все страницы копируются
+    в одной транзакции чтения: в режиме WAL она не блокирует запись в базу, а копирование
+    частями перезапускалось бы после каждой записи из других подключений.
+    Вернет размер страницы
+    """
+
+    src = sqlite3.connect(db_file_name)
+    dst = sqlite3.connect(snapshot_file_name)
+    try:
+        src.backup(dst)
+
+        # Снимок хранится одним файлом, без WAL
+        dst.execute("PRAGMA journal_mode=DELETE")
+        return dst.execute("PRAGMA page_size").fetchone()[0]
+
+    finally:
+        dst.close()
+        src.close()
+
+
+def check_integrity(db_file_name: Union[str, Path]):
+    connect = sqlite3.connect(f"file:{db_file_name}?mode=ro", uri=True)
+    try:
+        result = connect.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        connect.close()
+
+    if result != "ok":
+        raise BackupError(f"Integrity check of {db_file_name} failed: {result}")
+
+
+def iter_chunks(file_name: Path, chunk_size: int) -> Iterator[bytes]:
+    with open(file_name, "rb") as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+def write_gzip_atomic(file_name: Path, chunks: Iterator[bytes]):
+    file_name_temp = file_name.with_name(f"{file_name.name}.tmp")
+    with gzip.open(file_name_temp, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(file_name_temp, file_name)
+
+
+class DatabaseBackup:
+    """
+    Бэкапы базы SQLite в backup_dir. Каждый бэкап описывается файлом <name>.json
+    с размером и sha256 снимка:
+        full        - сжатый снимок целиком в <name>.sqlite.gz
+        incremental - снимок частями по chunk_size (кратно размеру страницы), части
+                      хранятся сжатыми в chunks/<sha256>.gz, записываются только новые части
+    """
+
+    MODE_FULL = "full"
+    MODE_INCREMENTAL = "incremental"
+
+    def __init__(
+        self,
+        db_file_name: Union[str, Path],
+        backup_dir: Path,
+        mode: str = MODE_INCREMENTAL,
+        chunk_size: int = BACKUP_CHUNK_SIZE,
+        log: logging.Logger = None,
+    ):
+        if mode not in (self.MODE_FULL, self.MODE_INCREMENTAL):
+            raise ValueError(f"Unknown backup mode: {mode!r}")
+
+        self.db_file_name = db_file_name
+        self.backup_dir = Path(backup_dir)
+        self.dir_chunks = self.backup_dir / "chunks"
+        self.mode = mode
+        self.chunk_size = chunk_size
+        self.log = log
+
+    def _get_chunk_file_name(self, sha256: str) -> Path:
+        return self.dir_chunks / f"{sha256}.gz"
+
+    def get_manifest_file_name(self, name: str) -> Path:
+        return self.backup_dir / f"{name}.json"
+
+    def create(self, name: str = None) -> Path:
+        """
+        Создание бэкапа с проверкой снимка и записанных файлов. Вернет путь к описанию бэкапа
+        """
+
+        if not name:
+            name = dt.datetime.now().strftime("%Y-%m-%d_%H%M%S")
+
+        self.backup_dir.mkdir(parents=True, exist_ok=True)
+        snapshot_file_name = self.backup_dir / f"{name}.sqlite.tmp"
+
+        try:
+            page_size = create_snapshot(self.db_file_name, snapshot_file_name)
+            check_integrity(snapshot_file_name)
+
+            # Части снимка кратны размеру страницы, чтобы неизмененные страницы давали те же части
+            chunk_size = max(self.chunk_size // page_size, 1) * page_size
+
+            sha256 = hashlib.sha256()
+            manifest = dict(
+                name=name,
+                mode=self.mode,
+                date_time=dt.datetime.now().isoformat(),
+                page_size=page_size,
+                size=snapshot_file_name.stat().st_size,
+            )
+
+            if self.mode == self.MODE_FULL:
+                file_name = self.backup_dir / f"{name}.sqlite.gz"
+
+                def _iter_with_hash():
+                    for chunk in iter_chunks(snapshot_file_name, chunk_size):
+                        sha256.update(chunk)
+                        yield chunk
+
+                write_gzip_atomic(file_name, _iter_with_hash())
+                manifest["file_name"] = file_name.name
+
+            else:
+                self.dir_chunks.mkdir(parents=True, exist_ok=True)
+
+                chunks = []
+                new_chunks = 0
+                for chunk in iter_chunks(snapshot_file_name, chunk_size):
+                    sha256.update(chunk)
+
+                    chunk_sha256 = hashlib.sha256(chunk).hexdigest()
+                    chunks.append(chunk_sha256)
+
+                    chunk_file_name = self._get_chunk_file_name(chunk_sha256)
+                    if not chunk_file_name.exists():
+                        write_gzip_atomic(chunk_file_name, iter([chunk]))
+                        new_chunks += 1
+
+                manifest["chunk_size"] = chunk_size
+                manifest["chunks"] = chunks
+                manifest["new_chunks"] = new_chunks
+
+            manifest["sha256"] = sha256.hexdigest()
+
+        finally:
+            snapshot_file_name.unlink(missing_ok=True)
+
+        manifest_file_name = self.get_manifest_file_name(name)
+        manifest_file_name_temp = manifest_file_name.with_name(f"{manifest_file_name.name}.tmp")
+        manifest_file_name_temp.write_text(json.dumps(manifest, indent=4), "utf-8")
+
+        self.verify(manifest_file_name_temp)
+        os.replace(manifest_file_name_temp, manifest_file_name)
+
+        if self.log:
+            text = f"size {manifest['size']}"
+            if self.mode == self.MODE_INCREMENTAL:
+                text += f", new chunks {manifest['new_chunks']}/{len(manifest['chunks'])}"
+            self.log.info(f"[{self.__class__.__name__}] Created backup {name}: {text}")
+
+        return manifest_file_name
+
+    def iter_content(self, manifest_file_name: Path) -> Iterator[bytes]:
+        """
+        Содержимое снимка базы из бэкапа
+        """
+
+        manifest = json.loads(manifest_file_name.read_text("utf-8"))
+
+        if manifest["mode"] == self.MODE_FULL:
+            with gzip.open(self.backup_dir / manifest["file_name"], "rb") as f:
+                while chunk := f.read(self.chunk_size):
+                    yield chunk
+            return
+
+        for chunk_sha256 in manifest["chunks"]:
+            with gzip.open(self._get_chunk_file_name(chunk_sha256), "rb") as f:
+                chunk = f.read()
+
+            if hashlib.sha256(chunk).hexdigest() != chunk_sha256:
+                raise BackupError(f"Chunk {chunk_sha256} is corrupted")
+
+            yield chunk
+
+    def verify(self, manifest_file_name: Path):
+        """
+        Проверка, что файлы бэкапа читаются и совпадают со снимком по размеру и sha256
+        """
+
+        manifest = json.loads(manifest_file_name.read_text("utf-8"))
+
+        size = 0
+        sha256 = hashlib.sha256()
+        for chunk in self.iter_content(manifest_file_name):
+            size += len(chunk)
+            sha256.update(chunk)
+
+        if size != manifest["size"] or sha256.hexdigest() != manifest["sha256"]:
+            raise BackupError(f"Backup {manifest['name']} does not match its snapshot")
+
+    def restore(self, manifest_file_name: Path, db_file_name: Union[str, Path]):
+        """
+        Восстановление базы из бэкапа в db_file_name с проверкой целостности
+        """
+
+        db_file_name = Path(db_file_name)
+        db_file_name_temp = db_file_name.with_name(f"{db_file_name.name}.tmp")
+        with open(db_file_name_temp, "wb") as f:
+            for chunk in self.iter_content(manifest_file_name):
+                f.write(chunk)
+
+        check_integrity(db_file_name_temp)
+        os.replace(db_file_name_temp, db_file_name)
+
+    def get_manifest_file_names(self) -> List[Path]:
+        # Имена бэкапов - даты, поэтому сортировка по имени идет от старых к новым
+        return sorted(self.backup_dir.glob("*.json"))
+
+    def get_last_manifest_file_name(self) -> Optional[Path]:
+        items = self.get_manifest_file_names()
+        return items[-1] if items else None
+
+    def remove_old(self, keep: int) -> List[str]:
+        """
+        Удаление бэкапов, кроме keep последних, вместе с их частями, на которые больше
+        не ссылается ни один бэкап. Вернет имена удаленных бэкапов
+        """
+
+        if keep < 1:
+            raise ValueError(f"At least one backup must be kept, got keep={keep}")
+
+        removed = []
+        for manifest_file_name in self.get_manifest_file_names()[:-keep]:
+            manifest = json.loads(manifest_file_name.read_text("utf-8"))
+            if manifest.get("file_name"):
+                (self.backup_dir / manifest["file_name"]).unlink(missing_ok=True)
+
+            manifest_file_name.unlink()
+            removed.append(manifest["name"])
+
+        removed_chunks = self.remove_unused_chunks()
+
+        if self.log and (removed or removed_chunks):
+            self.log.info(
+                f"[{self.__class__.__name__}] Removed old backups: {removed}, "
+                f"unused chunks: {removed_chunks}"
+            )
+
+        return removed
+
+    def remove_unused_chunks(self) -> int:
+        """
+        Удаление частей, на которые не ссылается ни один бэкап. Вернет количество удаленных
+        """
+
+        if not self.dir_chunks.exists():
+            return 0
+
+        used = set()
+        for manifest_file_name in self.backup_dir.glob("*.json"):
+            manifest = json.loads(manifest_file_name.read_text("utf-8"))
+            used.update(manifest.get("chunks", []))
+
+        number = 0
+        for chunk_file_name in self.dir_chunks.glob("*.gz"):
+            if chunk_file_name.name.split(".")[0] not in used:
+                chunk_file_name.unlink()
+                number += 1
+
+        return number
+
+
+def get_file_sha256(file_name: Union[str, Path]) -> str:
+    sha256 = hashlib.sha256()
+    for chunk in iter_chunks(Path(file_name), 1024 * 1024):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+# ioctl FICLONE из linux/fs.h
+FICLONE = 0x40049409
+
+
+def reflink(src: Path, dst: Path):
+    """
+    Копия файла, разделяющая с ним блоки на диске (Btrfs, XFS). Работает только в Linux
+    """
+
+    if not fcntl or not hasattr(fcntl, "ioctl"):
+        raise OSError("Reflink is not supported on this platform")
+
+    with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+        fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+
+
+class ComicsBackup:
+    """
+    Бэкап файлов комиксов в backup_dir по описанию manifest.json: для каждого файла
+    хранятся размер, время изменения и sha256. Файлы, у которых размер и время изменения
+    совпадают с описанием и которые есть в backup_dir (одно чтение папки), пропускаются,
+    остальные проверяются по sha256 и переносятся пулом потоков:
+        copy     - копирование
+        hardlink - жесткая ссылка, файлы комиксов не изменяются на месте (write_bytes_atomic),
+                   поэтому бэкап не изменится вместе с исходным файлом
+        reflink  - копия, разделяющая блоки на диске, при неудаче - копирование
+    Для hardlink и reflink папки должны быть на одной файловой системе, иначе - копирование
+    """
+
+    MODE_COPY = "copy"
+    MODE_HARDLINK = "hardlink"
+    MODE_REFLINK = "reflink"
+
+    MANIFEST_FILE_NAME = "manifest.json"
+
+    def __init__(
+        self,
+        dir_comics: Path,
+        backup_dir: Path,
+        mode: str = MODE_COPY,
+        workers: int = BACKUP_COMICS_WORKERS,
+        log: logging.Logger = None,
+    ):
+        if mode not in (self.MODE_COPY, self.MODE_HARDLINK, self.MODE_REFLINK):
+            raise ValueError(f"Unknown comics backup mode: {mode!r}")
+
+        self.dir_comics = Path(dir_comics)
+        self.backup_dir = Path(backup_dir)
+        self.manifest_file_name = self.backup_dir / self.MANIFEST_FILE_NAME
+        self.mode = mode
+        self.workers = workers
+        self.log = log
+
+    def load_manifest(self) -> Optional[Dict[str, dict]]:
+        try:
+            return json.loads(self.manifest_file_name.read_text("utf-8"))
+        except FileNotFoundError:
+            return
+
+    def save_manifest(self, manifest: Dict[str, dict]):
+        file_name_temp = self.manifest_file_name.with_name(f"{self.manifest_file_name.name}.tmp")
+        file_name_temp.write_text(json.dumps(manifest, indent=4, sort_keys=True), "utf-8")
+        os.replace(file_name_temp, self.manifest_file_name)
+
+    def get_mode(self) -> str:
+        if self.mode == self.MODE_COPY:
+            return self.mode
+
+        if os.stat(self.dir_comics).st_dev != os.stat(self.backup_dir).st_dev:
+            if self.log:
+                self.log.warning(
+                    f"[{self.__class__.__name__}] {self.mode} is not possible between "
+                    f"different file systems, files will be copied"
+                )
+            return self.MODE_COPY
+
+        return self.mode
+
+    def _transfer(self, src: Path, dst: Path, mode: str):
+        dst_temp = dst.with_name(f"{dst.name}.tmp")
+        dst_temp.unlink(missing_ok=True)
+
+        if mode == self.MODE_HARDLINK:
+            os.link(src, dst_temp)
+
+        elif mode == self.MODE_REFLINK:
+            try:
+                reflink(src, dst_temp)
+            except OSError:
+                shutil.copy2(src, dst_temp)
+
+        else:
+            shutil.copy2(src, dst_temp)
+
+        os.replace(dst_temp, dst)
+
+    def _backup_file(
+        self,
+        entry: os.DirEntry,
+        stat: os.stat_result,
+        old_sha256: Optional[str],
+        mode: str,
+        check_existing: bool = False,
+    ) -> Tuple[str, dict, bool]:
+        sha256 = get_file_sha256(entry.path)
+
+        if check_existing:
+            old_sha256 = get_file_sha256(self.backup_dir / entry.name)
+
+        # Содержимое не изменилось, например, файл скачан повторно
+        copied = sha256 != old_sha256
+        if copied:
+            self._transfer(Path(entry.path), self.backup_dir / entry.name, mode)
+
+        record = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=sha256)
+        return entry.name, record, copied
+
+    def _get_existing_names(self) -> Set[str]:
+        """
+        Имена уже сохраненных файлов: одно чтение папки без stat каждого файла
+        """
+
+        with os.scandir(self.backup_dir) as it:
+            return {entry.name for entry in it if entry.name != self.MANIFEST_FILE_NAME}
+
+    def _get_existing_sizes(self) -> Dict[str, int]:
+        """
+        Размеры уже сохраненных файлов, нужны только при первом запуске без manifest.json
+        """
+
+        with os.scandir(self.backup_dir) as it:
+            return {
+                entry.name: entry.stat().st_size
+                for entry in it
+                if entry.is_file() and entry.name != self.MANIFEST_FILE_NAME
+            }
+
+    def create(self) -> Tuple[int, int]:
+        """
+        Вернет количество проверенных и скопированных файлов
+        """
+
+        self.backup_dir.mkdir(parents=True, exist_ok=True)
+        mode = self.get_mode()
+
+        manifest = self.load_manifest()
+
+        # Бэкап, сделанный до появления manifest.json: файлы того же размера
+        # считаются сохраненными, если совпадет sha256 с исходным файлом
+        existing_sizes = dict()
+        if manifest is None:
+            manifest = dict()
+            existing_sizes = self._get_existing_sizes()
+
+        # Файлы, удаленные из backup_dir после прошлого бэкапа, копируются заново
+        existing_names = self._get_existing_names()
+
+        items: List[Tuple[os.DirEntry, os.stat_result, Optional[str], bool]] = []
+        with os.scandir(self.dir_comics) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+
+                stat = entry.stat()
+                record = manifest.get(entry.name)
+                if record and entry.name not in existing_names:
+                    items.append((entry, stat, None, False))
+
+                elif record:
+                    if record["size"] == stat.st_size and record["mtime_ns"] == stat.st_mtime_ns:
+                        continue
+
+                    items.append((entry, stat, record["sha256"], False))
+
+                else:
+                    check_existing = existing_sizes.get(entry.name) == stat.st_size
+                    items.append((entry, stat, None, check_existing))
+
+        copied = 0
+        with ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix=self.__class__.__name__
+        ) as executor:
+            futures = [
+                executor.submit(self._backup_file, entry, stat, old_sha256, mode, check_existing)
+                for entry, stat, old_sha256, check_existing in items
+            ]
+
+            try:
+                for future in futures:
+                    name, record, is_copied = future.result()
+                    manifest[name] = record
+                    copied += is_copied
+
+            finally:
+                # Уже перенесенные файлы сохраняются в описании даже при ошибке
+                self.save_manifest(manifest)
+
+        if self.log:
+            self.log.info(
+                f"[{self.__class__.__name__}] Checked {len(items)} files, copied {copied} ({mode})"
+            )
+
+        return len(items), copied
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from pathlib import Path
+from threading import Condition, Lock
+from typing import Deque, List, Optional, Set, Tuple
+
+from bot import db
+from config import (
+    DIR_COMICS,
+    COMICS_DOWNLOAD_WORKERS,
+    COMICS_DOWNLOAD_MAX_PENDING,
+)
+from common import log
+from third_party import bash_im
+
+
+class ComicsDownloader:
+    """
+    Фоновое скачивание комиксов пулом потоков. Скачанные файлы записываются в Comics.
+    В пуле не больше max_pending задач, остальные цитаты откладываются и ставятся
+    в пул по мере завершения задач, поэтому submit не ждет
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        max_pending: int,
+        log: logging.Logger = None,
+    ):
+        self.log = log
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=self.__class__.__name__
+        )
+
+        self.max_pending = max_pending
+
+        # Количество задач в пуле и отложенные из-за переполнения цитаты
+        self._pending_condition = Condition()
+        self._pending = 0
+        self._deferred: Deque[Tuple[bash_im.Quote, Path]] = deque()
+
+        self._lock = Lock()
+        self._in_progress: Set[Path] = set()
+
+        self.total_files = 0
+
+    @property
+    def depth(self) -> int:
+        with self._pending_condition:
+            return self._pending + len(self._deferred)
+
+    def submit(self, quote: bash_im.Quote, dir_comics: Path = DIR_COMICS) -> Optional[Future]:
+        """
+        Постановка в очередь скачивания комиксов цитаты. Цитата уже должна быть в базе.
+        Вернет None, если пул заполнен и цитата отложена
+        """
+
+        with self._pending_condition:
+            if self._pending >= self.max_pending:
+                self._deferred.append((quote, dir_comics))
+                return
+
+            self._pending += 1
+
+        return self._submit(quote, dir_comics)
+
+    def _submit(self, quote: bash_im.Quote, dir_comics: Path) -> Future:
+        try:
+            future = self._executor.submit(self._download, quote, dir_comics)
+        except Exception:
+            self._on_done()
+            raise
+
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, _: Future = None):
+        # Место освободившейся задачи занимает отложенная цитата
+        with self._pending_condition:
+            if self._deferred:
+                quote, dir_comics = self._deferred.popleft()
+            else:
+                self._pending -= 1
+                self._pending_condition.notify_all()
+                return
+
+        self._submit(quote, dir_comics)
+
+    def join(self, timeout: float = None) -> bool:
+        """
+        Ожидание окончания всех скачиваний, в том числе отложенных
+        """
+
+        with self._pending_condition:
+            return self._pending_condition.wait_for(
+                lambda: not self._pending and not self._deferred, timeout=timeout
+            )
+
+    def _download_file(self, url: str, file_name: Path):
+        with self._lock:
+            # Этот же файл уже скачивается в другом потоке
+            if file_name in self._in_progress:
+                return
+
+            self._in_progress.add(file_name)
+
+        # Частоту запросов ограничивает общий bash_im.rate_limiter
+        try:
+            url_img = bash_im.get_comics_image_url(url)
+            bash_im.download_comics_file(url_img, file_name)
+
+        finally:
+            with self._lock:
+                self._in_progress.discard(file_name)
+
+    def _download(self, quote: bash_im.Quote, dir_comics: Path) -> List[str]:
+        dir_comics.mkdir(parents=True, exist_ok=True)
+
+        files = []
+        for url in quote.comics_urls:
+            file_name = dir_comics / bash_im.get_comics_file_name(quote.id, url)
+
+            try:
+                # Если нет файла, скачиваем
+                if not file_name.exists():
+                    self._download_file(url, file_name)
+
+                if file_name.exists():
+                    files.append(str(file_name.resolve()))
+
+            except Exception:
+                if self.log:
+                    self.log.exception(f"Error by downloading comics {url}:")
+
+        try:
+            db.Comics.add_files(quote.id, files)
+        except Exception:
+            if self.log:
+                self.log.exception(f"Error by saving comics files of quote #{quote.id}:")
+
+        with self._lock:
+            self.total_files += len(files)
+
+        return files
+
+
+comics_downloader = ComicsDownloader(
+    workers=COMICS_DOWNLOAD_WORKERS,
+    max_pending=COMICS_DOWNLOAD_MAX_PENDING,
+    log=log,
+)
@@ -9,7 +9,10 @@ import enum
 import logging
 import re
 import time
-from typing import Optional, Dict, List, Callable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from threading import Lock
+from typing import Optional, Dict, List, Callable, Set
 
 # pip install python-telegram-bot
 from telegram import (
@@ -19,8 +22,9 @@ from telegram import (
     InlineKeyboardMarkup,
     ChatAction,
     ParseMode,
+    Message,
 )
-from telegram.error import NetworkError
+from telegram.error import NetworkError, BadRequest
 from telegram.ext import (
     Updater,
     MessageHandler,
@@ -33,7 +37,6 @@ from telegram.ext import (
 import bot.db as db
 from config import (
     ERROR_TEXT,
-    DIR_COMICS,
     CHECKBOX,
     CHECKBOX_EMPTY,
     RADIOBUTTON,
@@ -42,6 +45,8 @@ from config import (
     ITEMS_PER_PAGE,
     ERRORS_PER_PAGE,
     LENGTH_TEXT_OF_SMALL_QUOTE,
+    QUOTES_LOW_WATERMARK,
+    QUOTES_PREFETCH_WORKERS,
 )
 from common import (
     log,
@@ -132,11 +137,23 @@ INLINE_KEYBOARD_BUTTON_BACK = InlineKeyboardButton(
 )
 
 
+# Для изменения кэшей цитат пользователей из обработчиков и фонового пополнения
+quotes_lock = Lock()
+
+# Фоновое пополнение кэшей цитат, не больше одного на пользователя одновременно
+prefetch_executor = ThreadPoolExecutor(
+    max_workers=QUOTES_PREFETCH_WORKERS, thread_name_prefix="prefetch"
+)
+prefetch_lock = Lock()
+prefetch_user_ids = set()
+
+
 def get_random_quote(update: Update, context: CallbackContext) -> Optional[db.Quote]:
     user = db.User.get_from(update.effective_user)
 
+    # После перезапуска бота кэш восстанавливается из базы
     if "quotes" not in context.user_data:
-        context.user_data["quotes"] = []
+        context.user_data["quotes"] = db.QuoteCache.get_quotes(user)
 
     quotes = context.user_data["quotes"]
     log.debug(f"get_random_quote (quotes: {len(quotes)})")
@@ -151,10 +168,63 @@ def get_random_quote(update: Update, context: CallbackContext) -> Optional[db.Qu
             user, years_of_quotes, filter_quote_by_max_length_text, log, update, context
         )
 
-    if quotes:
-        return quotes.pop()
+    with quotes_lock:
+        quote = quotes.pop() if quotes else None
+
+    # Цитаты заканчиваются, пополним кэш заранее, не задерживая ответ.
+    # Выданная цитата отмечается просмотренной только после ответа, поэтому
+    # фоновое пополнение должно ее исключить само
+    if quote and len(quotes) < QUOTES_LOW_WATERMARK:
+        prefetch_cache(user, context.user_data, exclude_ids={quote.id})
+
+    return quote
+
 
-    return
+def prefetch_cache(user: db.User, user_data: Dict, exclude_ids: Set[int] = None):
+    with prefetch_lock:
+        if user.id in prefetch_user_ids:
+            return
+
+        prefetch_user_ids.add(user.id)
+
+    generation = user_data.get("quotes_generation", 0)
+    # Снимок берется сразу: цитаты, выданные из кэша позже, в нем уже есть
+    with quotes_lock:
+        exclude_ids = set(exclude_ids or ()) | {quote.id for quote in user_data["quotes"]}
+
+    prefetch_executor.submit(_prefetch_cache, user, user_data, generation, exclude_ids)
+
+
+def _prefetch_cache(user: db.User, user_data: Dict, generation: int, exclude_ids: Set[int]):
+    try:
+        quotes = user_data["quotes"]
+        log.debug(f"Start [{prefetch_cache.__name__}] for user #{user.id}. Quotes: {len(quotes)}")
+
+        new_quotes = user.get_user_unique_random(
+            years=user.get_list_years_of_quotes(),
+            filter_quote_by_max_length_text=user.get_filter_quote_by_max_length_text(),
+            exclude_ids=exclude_ids,
+        )
+
+        with quotes_lock:
+            # Кэш за это время был перегенерирован (например, после смены настроек)
+            if user_data.get("quotes_generation", 0) != generation:
+                return
+
+            # Цитаты берутся с конца списка, поэтому новые добавляются в начало
+            quotes[:0] = new_quotes
+
+        db.QuoteCache.set_quotes(user, quotes)
+
+        log.debug(f"Finish [{prefetch_cache.__name__}] for user #{user.id}. Quotes: {len(quotes)}")
+
+    except Exception as e:
+        log.exception(f"Error [{prefetch_cache.__name__}] for user #{user.id}:")
+        db.Error.create_from(prefetch_cache, e)
+
+    finally:
+        with prefetch_lock:
+            prefetch_user_ids.discard(user.id)
 
 
 def get_context_value(context: CallbackContext) -> Optional[str]:
@@ -279,8 +349,7 @@ def reply_quote_ids(items: List[int], update: Update, context: CallbackContext):
 def reply_get_used_quote(
     user_id: int, quote_id: int, update: Update, context: CallbackContext
 ):
-    sub_query = db.Request.get_all_quote_id_by_user(user_id)
-    items = [i for i, x in enumerate(sub_query) if x.quote_id == quote_id]
+    items = db.Request.get_quote_positions_by_user(user_id, quote_id)
     if items:
         text = f"Цитата #{quote_id} найдена в {items}"
     else:
@@ -336,16 +405,24 @@ def update_cache(
         context.user_data["quotes"] = []
 
     quotes = context.user_data["quotes"]
-    quotes.clear()
 
     if years:
         log.debug(f'Quotes from year(s): {", ".join(map(str, years))}.')
 
-    quotes += user.get_user_unique_random(
+    new_quotes = user.get_user_unique_random(
         years=years,
         filter_quote_by_max_length_text=filter_quote_by_max_length_text
     )
 
+    with quotes_lock:
+        quotes.clear()
+        quotes += new_quotes
+
+        # Результаты запущенного ранее фонового пополнения станут неактуальными
+        context.user_data["quotes_generation"] = context.user_data.get("quotes_generation", 0) + 1
+
+    db.QuoteCache.set_quotes(user, quotes)
+
     log.debug(f"Finish [{update_cache.__name__}]. Quotes: {len(quotes)}")
 
 
@@ -556,19 +633,17 @@ def on_get_user_stats(update: Update, context: CallbackContext):
     """
 
     user = db.User.get_from(update.effective_user)
+    stats = user.get_stats()
 
-    first_request = user.requests.first()
-    last_request = user.requests.order_by(db.Request.id.desc()).first()
-    elapsed_days = (last_request.date_time - first_request.date_time).days
-
-    quote_count = user.get_total_quotes()
-    quote_with_comics_count = user.get_total_quotes(with_comics=True)
+    elapsed_days = 0
+    if stats.first_request:
+        elapsed_days = (stats.last_request - stats.first_request).days
 
     text = f"""\
 <b>Статистика.</b>
 
-Получено цитат <b>{quote_count}</b>, с комиксами <b>{quote_with_comics_count}</b>
-Всего запросов боту: <b>{user.requests.count()}</b>
+Получено цитат <b>{stats.quotes}</b>, с комиксами <b>{stats.quotes_with_comics}</b>
+Всего запросов боту: <b>{stats.requests}</b>
 Разница между первым и последним запросом: <b>{elapsed_days}</b> дней
     """
 
@@ -583,15 +658,18 @@ def on_get_admin_stats(update: Update, context: CallbackContext):
      - admin[ _]stats или статистика[ _]админа
     """
 
-    quote_count = db.Quote.select().count()
-    quote_with_comics_count = db.Quote.get_all_with_comics().count()
+    quote_count, quote_with_comics_count = db.QuoteYearStats.get_totals()
+    user_count = db.Counter.get_value(db.Counter.USERS)
+    request_count = db.Counter.get_value(db.Counter.REQUESTS)
+    request_buffer = db.request_buffer
 
     text = f"""\
 <b>Статистика админа.</b>
 
-Пользователей: <b>{db.User.select().count()}</b>
+Пользователей: <b>{user_count}</b>
 Цитат <b>{quote_count}</b>, с комиксами <b>{quote_with_comics_count}</b>
-Запросов: <b>{db.Request.select().count()}</b>
+Запросов: <b>{request_count}</b>
+Буфер запросов: <b>{request_buffer.depth}</b>, запись последней пачки <b>{request_buffer.last_flush_elapsed_ms}</b> мс (макс. <b>{request_buffer.max_flush_elapsed_ms}</b> мс)
 
 Бот запущен с <b>{get_date_str(START_TIME)}</b> (прошло <b>{get_elapsed_time(START_TIME)}</b>)
 С первого запроса прошло <b>{get_elapsed_time(db.Request.get_first_date_time())}</b>
@@ -675,11 +753,10 @@ def on_get_quote_stats(update: Update, context: CallbackContext):
     if query:
         query.answer()
 
-    quote_count = db.Quote.select().count()
-    quote_with_comics_count = db.Quote.get_all_with_comics().count()
+    quote_count, quote_with_comics_count = db.QuoteYearStats.get_totals()
 
     text_year_by_counts = "\n".join(
-        f"    <b>{year}</b>: {count}" for year, count in db.Quote.get_year_by_counts()
+        f"    <b>{stats.year}</b>: {stats.quotes}" for stats in db.QuoteYearStats.get_all()
     )
 
     text = f"""\
@@ -717,17 +794,11 @@ def on_get_comics_stats(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
 
-    quote_query = db.Quote.get_all_with_comics()
-    quote_count = quote_query.count()
-
-    year_by_number = {k: 0 for k in db.Quote.get_years()}
-    for quote in quote_query.select(db.Quote.date):
-        year = quote.date.year
-        year_by_number[year] += 1
+    _, quote_count = db.QuoteYearStats.get_totals()
 
     text_year_by_counts = "\n".join(
-        f"    <b>{year}</b>: {count}"
-        for year, count in year_by_number.items()
+        f"    <b>{stats.year}</b>: {stats.quotes_with_comics}"
+        for stats in db.QuoteYearStats.get_all()
     )
 
     text = f"""\
@@ -775,7 +846,7 @@ def on_get_users_short(update: Update, context: CallbackContext):
 
     items = []
     for i, user in enumerate(users, start):
-        short_title = user.get_short_title()
+        short_title = user.get_short_title(total_quotes=user.total_quotes)
         short_title = f"{i}. {short_title}"
         items.append(short_title)
 
@@ -852,7 +923,7 @@ def on_get_group_chats_short(update: Update, context: CallbackContext):
 
     items = []
     for i, chat in enumerate(chats, start):
-        short_title = chat.get_short_title_for_group()
+        short_title = chat.get_short_title_for_group(requests=chat.requests_count)
         short_title = f"{i}. {short_title}"
         items.append(short_title)
 
@@ -983,7 +1054,7 @@ def on_get_external_quote(update: Update, context: CallbackContext):
         reply_error("Номер цитаты не указан", update, context)
         return
 
-    quote_obj = bash_im.Quote.parse_from(quote_id)
+    quote_obj = bash_im.Quote.parse_from(quote_id, force_revalidate=True)
     if not quote_obj:
         reply_error(f"Цитаты #{quote_id} на сайте нет", update, context)
         return
@@ -1011,8 +1082,9 @@ def on_update_quote(update: Update, context: CallbackContext):
 def on_find_my(update: Update, context: CallbackContext):
     r"""
     Поиск цитат среди уже полученных:
-     - /find_my <текст в регулярном выражении>
-     - find my <текст в регулярном выражении>
+     - /find_my <текст>
+     - find my <текст>
+    Текст: подстрока или регулярное выражение, поиск по словам - "фраза" или префикс*
     """
 
     user = db.User.get_from(update.effective_user)
@@ -1026,12 +1098,13 @@ def on_find_my(update: Update, context: CallbackContext):
 def on_find(update: Update, context: CallbackContext):
     r"""
     Поиск цитат в базе:
-     - /find <текст в регулярном выражении>
-     - find <текст в регулярном выражении>
+     - /find <текст>
+     - find <текст>
+    Текст: подстрока или регулярное выражение, поиск по словам - "фраза" или префикс*
     """
 
     value = get_context_value(context)
-    items = db.Quote.find(value)
+    items = db.Quote.find_by_query(value)
     reply_quote_ids(items, update, context)
 
 
@@ -1039,15 +1112,16 @@ def on_find(update: Update, context: CallbackContext):
 def on_find_new(update: Update, context: CallbackContext):
     r"""
     Поиск цитат в базе, что еще не были получены:
-     - /find_new <текст в регулярном выражении>
-     - find new <текст в регулярном выражении>
+     - /find_new <текст>
+     - find new <текст>
+    Текст: подстрока или регулярное выражение, поиск по словам - "фраза" или префикс*
     """
 
     user = db.User.get_from(update.effective_user)
     value = get_context_value(context)
 
-    items_all = db.Quote.find(value)
-    items_user = user.find_quote_ids(value)
+    items_all = db.Quote.find_by_query(value)
+    items_user = set(user.find_quote_ids(value))
     items = [x for x in items_all if x not in items_user]
 
     reply_quote_ids(items, update, context)
@@ -1103,15 +1177,48 @@ def on_quote_comics(update: Update, context: CallbackContext):
         chat_id=query.message.chat_id, action=ChatAction.UPLOAD_PHOTO
     )
 
-    quote_id = query.data
-    files = list(DIR_COMICS.glob(f"quote{quote_id}_*.png"))
+    quote_id = int(query.data)
+
+    # Только скачанные комиксы
+    items = [
+        comics for comics in db.Comics.get_all_by_quote(quote_id)
+        if comics.file_name
+    ]
     max_parts = 10
 
-    for i in range(0, len(files), max_parts):
-        media = [
-            InputMediaPhoto(f.open("rb")) for f in files[i : i + max_parts]
-        ]
-        query.message.reply_media_group(media=media, quote=True)
+    for i in range(0, len(items), max_parts):
+        part = items[i : i + max_parts]
+
+        try:
+            messages = reply_comics_media_group(query.message, part, use_file_id=True)
+        except BadRequest:
+            # Telegram не принял сохраненные file_id, файлы отправляются заново
+            if not any(comics.file_id for comics in part):
+                raise
+
+            log.exception(f"Error sending comics of quote #{quote_id} by file_id")
+            messages = reply_comics_media_group(query.message, part, use_file_id=False)
+
+        for comics, message in zip(part, messages):
+            if message.photo:
+                comics.set_file_id(message.photo[-1].file_id)
+
+
+def reply_comics_media_group(
+    message: Message,
+    items: List[db.Comics],
+    use_file_id: bool,
+) -> List[Message]:
+    with ExitStack() as stack:
+        media = []
+        for comics in items:
+            if use_file_id and comics.file_id:
+                media.append(InputMediaPhoto(comics.file_id))
+            else:
+                f = stack.enter_context(comics.get_file_path().open("rb"))
+                media.append(InputMediaPhoto(f))
+
+        return message.reply_media_group(media=media, quote=True)
 
 
 @mega_process
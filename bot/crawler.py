@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import datetime as dt
+import logging
+import time
+from pathlib import Path
+from threading import Event, Lock, Thread
+from typing import Callable, List
+
+from bot import db
+from config import DIR_COMICS
+from third_party import bash_im
+
+
+class ArchiveCrawler:
+    """
+    Обход страниц архива bash.im несколькими потоками. Очередь страниц и их состояние
+    хранятся в CrawlPage, поэтому после перезапуска обход продолжается с того же места.
+    Частоту запросов всех потоков вместе ограничивает общий для запросов к bash.im
+    bash_im.rate_limiter
+    """
+
+    def __init__(
+        self,
+        save_quotes: Callable[[List[bash_im.Quote], Path], List[int]],
+        workers: int,
+        max_attempts: int,
+        retry_seconds: int,
+        log: logging.Logger = None,
+    ):
+        self.save_quotes = save_quotes
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.log = log
+
+        self._stop = Event()
+        self._lock = Lock()
+
+        self.pages_done = 0
+        self.pages_failed = 0
+        self.new_quotes = 0
+
+    def stop(self):
+        self._stop.set()
+
+    def add_pages(self, total_pages: int, checked_pages_from: int = None) -> int:
+        """
+        Добавление в очередь страниц 1..total_pages, которых в ней еще нет.
+        checked_pages_from: страницы после нее уже обработаны (например, прежним обходом)
+        """
+
+        if checked_pages_from is None or checked_pages_from >= total_pages:
+            return db.CrawlPage.add_pages(range(1, total_pages + 1))
+
+        number = db.CrawlPage.add_pages(range(1, checked_pages_from + 1))
+        number += db.CrawlPage.add_pages(
+            range(checked_pages_from + 1, total_pages + 1),
+            status=db.CrawlPage.STATUS_DONE,
+        )
+        return number
+
+    def _process_page(self, page: int, dir_comics: Path):
+        try:
+            quotes = bash_im.get_page_quotes(page, self.log, raise_error=True)
+            if not quotes:
+                raise Exception(f"Not found quotes on page {page}")
+
+            new_ids = self.save_quotes(quotes, dir_comics)
+
+        except Exception as e:
+            will_retry = db.CrawlPage.set_error(
+                page,
+                error=f"{type(e).__name__}: {e}",
+                retry_seconds=self.retry_seconds,
+                max_attempts=self.max_attempts,
+            )
+            if self.log:
+                self.log.warning(
+                    f"[{self.__class__.__name__}] Error on page {page} "
+                    f"({'will retry' if will_retry else 'failed'}): {e}"
+                )
+
+            if not will_retry:
+                with self._lock:
+                    self.pages_failed += 1
+            return
+
+        db.CrawlPage.set_done(page, quotes=len(quotes), new_quotes=len(new_ids))
+        with self._lock:
+            self.pages_done += 1
+            self.new_quotes += len(new_ids)
+
+    def _run_worker(self, dir_comics: Path):
+        while not self._stop.is_set():
+            pages = db.CrawlPage.claim(limit=1)
+            if pages:
+                self._process_page(pages[0], dir_comics)
+                continue
+
+            # Оставшиеся страницы ждут повторной попытки после ошибки
+            next_attempt_date_time = db.CrawlPage.get_next_attempt_date_time()
+            if not next_attempt_date_time:
+                return
+
+            timeout = (next_attempt_date_time - dt.datetime.now()).total_seconds()
+            self._stop.wait(min(max(timeout, 1), 60))
+
+    def run(self, dir_comics: Path = DIR_COMICS):
+        """
+        Обработка очереди, пока в ней есть страницы или не вызван stop
+        """
+
+        self._stop.clear()
+
+        # Страницы, обработка которых прервалась при прошлом запуске
+        number = db.CrawlPage.reset_in_progress()
+        if number and self.log:
+            self.log.info(f"[{self.__class__.__name__}] Resumed {number} pages")
+
+        t = time.perf_counter()
+        pages_done = self.pages_done
+
+        threads = [
+            Thread(
+                target=self._run_worker,
+                args=[dir_comics],
+                name=f"{self.__class__.__name__}_{i}",
+                daemon=True,
+            )
+            for i in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+
+        while True:
+            alive_threads = [thread for thread in threads if thread.is_alive()]
+            if not alive_threads:
+                break
+
+            alive_threads[0].join(timeout=60)
+
+            if self.log:
+                elapsed = time.perf_counter() - t
+                pages_per_minute = (self.pages_done - pages_done) * 60 / elapsed
+                self.log.debug(
+                    f"[{self.__class__.__name__}] Pages: {db.CrawlPage.get_number_by_status()}, "
+                    f"new quotes: {self.new_quotes}, {pages_per_minute:.1f} pages/min"
+                )
@@ -4,11 +4,19 @@
 __author__ = "ipetrash"
 
 
+import atexit
 import datetime as dt
+import hashlib
 import re
+import sqlite3
 import time
 import traceback
-from typing import List, Optional, Union, Callable, Tuple, Dict, Type, Iterable, TypeVar
+from pathlib import Path
+from threading import Lock
+from collections import Counter as CollectionsCounter, OrderedDict
+from typing import (
+    List, Optional, Union, Callable, Tuple, Dict, Type, Iterable, TypeVar, Container
+)
 
 # pip install peewee
 from peewee import (
@@ -22,8 +30,17 @@ from peewee import (
     JOIN,
     ModelSelect,
     Field,
+    Case,
+    Select,
+    chunked,
 )
 from playhouse.sqliteq import SqliteQueueDatabase
+from playhouse.sqlite_ext import SqliteExtDatabase, FTS5Model, SearchField, RowIDField
+
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
 
 import telegram
 
@@ -33,10 +50,23 @@ from config import (
     ERRORS_PER_PAGE,
     DB_FILE_NAME,
     DB_FILE_NAME_ERROR,
+    DIR_COMICS,
     ITEMS_PER_PAGE,
     QUOTES_LIMIT,
+    REQUEST_BUFFER_MAX_SIZE,
+    REQUEST_BUFFER_FLUSH_INTERVAL_MS,
+    REQUEST_BUFFER_MAX_ATTEMPTS,
+    REQUEST_BUFFER_MAX_PENDING,
+    LAST_ACTIVITY_BUFFER_MAX_SIZE,
+    LAST_ACTIVITY_FLUSH_INTERVAL_MS,
+    IDENTITY_CACHE_MAX_SIZE,
+    IDENTITY_CACHE_TTL_SECONDS,
+    SEEN_QUOTES_MAX_USERS,
+    SEEN_QUOTES_TTL_SECONDS,
 )
-from common import get_date_time_str, get_date_str, replace_bad_symbols
+from common import log, get_date_time_str, get_date_str, replace_bad_symbols
+from bot.quote_pool import QuotePool, SeenQuotes
+from bot.write_behind import WriteBehindBuffer
 
 
 def get_clear_name(full_name: str) -> str:
@@ -44,6 +74,101 @@ def get_clear_name(full_name: str) -> str:
     return full_name.strip()
 
 
+def get_full_text_query(text: str) -> Optional[str]:
+    """
+    Преобразование поискового запроса пользователя в запрос FTS5.
+    Поддерживаются слова, фразы в кавычках и префиксы (слово*).
+    Вернет None, если текст похож на регулярное выражение
+    """
+
+    if re.search(r"[\\^$.|?+()\[\]{}]", text) or text.count('"') % 2:
+        return
+
+    items = []
+    for term in re.findall(r'"[^"]*"|[^\s"]+', text):
+        is_prefix = False
+        if term.startswith('"'):
+            term = term.strip('"')
+        elif term.endswith("*"):
+            term = term[:-1]
+            is_prefix = True
+
+        if "*" in term:
+            return
+
+        # Термы без букв и цифр токенизатор все равно отбросит
+        if not re.search(r"\w", term):
+            continue
+
+        items.append(f'"{term}"' + ("*" if is_prefix else ""))
+
+    if not items:
+        return
+
+    return " ".join(items)
+
+
+def is_full_text_query(text: str) -> bool:
+    """
+    Поиск по словам выбирается явно: запрос содержит "фразу" в кавычках или префикс*.
+    Остальные запросы ищутся как подстрока или регулярное выражение
+    """
+
+    if not get_full_text_query(text):
+        return False
+
+    return '"' in text or bool(re.search(r"\w\*(\s|$)", text))
+
+
+def get_required_literals(regex: str, min_length: int = 3) -> List[str]:
+    """
+    Подстроки, которые обязательно встречаются в любом тексте, подходящем под регулярное выражение.
+    Используются для отбора кандидатов по триграммному индексу
+    """
+
+    try:
+        tokens = sre_parse.parse(regex)
+    except re.error:
+        return []
+
+    items = []
+
+    def _walk(tokens):
+        run = []
+
+        def _flush():
+            if len(run) >= min_length:
+                items.append("".join(run))
+            run.clear()
+
+        for op, av in tokens:
+            if op is sre_parse.LITERAL:
+                run.append(chr(av))
+
+            # Якоря (^, $, \b) ничего не поглощают и не разрывают подстроку
+            elif op is sre_parse.AT:
+                continue
+
+            elif op is sre_parse.SUBPATTERN:
+                _flush()
+                _walk(av[-1])
+
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+                _flush()
+
+                min_count, _, sub_tokens = av
+                if min_count > 0:
+                    _walk(sub_tokens)
+
+            else:
+                _flush()
+
+        _flush()
+
+    _walk(tokens)
+    return items
+
+
 # This working with multithreading
 # SOURCE: http://docs.peewee-orm.com/en/latest/peewee/playhouse.html#sqliteq
 db = SqliteQueueDatabase(
@@ -75,9 +200,68 @@ db_error = SqliteQueueDatabase(
 )
 
 
+# SqliteQueueDatabase не поддерживает транзакции, поэтому для пакетной записи
+# в одной транзакции используется отдельное подключение к той же базе
+db_batch = SqliteExtDatabase(
+    DB_FILE_NAME,
+    pragmas={
+        "foreign_keys": 1,
+        "journal_mode": "wal",     # WAL-mode
+        "cache_size": -1024 * 64,  # 64MB page-cache
+    },
+    timeout=30,  # Max. time to wait for the write lock.
+)
+
+
 ChildModel = TypeVar("ChildModel", bound="BaseModel")
 
 
+class IdentityCache:
+    """
+    Загруженные из базы объекты моделей, чтобы не перечитывать их на каждое обновление.
+    Хранится не больше max_size объектов, давно не используемые вытесняются.
+    Объекты старше ttl_seconds перечитываются из базы, чтобы подхватить изменения,
+    сделанные в обход кэша
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: int):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+
+        self._lock = Lock()
+        self._items: Dict[Tuple[Type["BaseModel"], int], Tuple[float, "BaseModel"]] = OrderedDict()
+
+    def get(self, model_cls: Type[ChildModel], obj_id: int) -> Optional[ChildModel]:
+        key = (model_cls, obj_id)
+        with self._lock:
+            item = self._items.get(key)
+            if not item:
+                return
+
+            added, obj = item
+            if time.monotonic() - added > self.ttl_seconds:
+                del self._items[key]
+                return
+
+            self._items.move_to_end(key)
+            return obj
+
+    def add(self, obj: "BaseModel"):
+        key = (obj.__class__, obj.id)
+        with self._lock:
+            self._items[key] = time.monotonic(), obj
+            self._items.move_to_end(key)
+
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+identity_cache = IdentityCache(
+    max_size=IDENTITY_CACHE_MAX_SIZE,
+    ttl_seconds=IDENTITY_CACHE_TTL_SECONDS,
+)
+
+
 class BaseModel(Model):
     class Meta:
         database = db
@@ -123,6 +307,25 @@ class BaseModel(Model):
 
         print(", ".join(items))
 
+    def update_changed_fields(self, **fields) -> bool:
+        """
+        Запись в базу только изменившихся полей. Вернет True, если что-то изменилось
+        """
+
+        changed = [
+            self._meta.fields[name]
+            for name, value in fields.items()
+            if getattr(self, name) != value
+        ]
+        if not changed:
+            return False
+
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+        self.save(only=changed)
+        return True
+
     def __str__(self):
         fields = []
         for k, field in self._meta.fields.items():
@@ -178,19 +381,26 @@ class User(BaseModel):
     settings = ForeignKeyField(Settings, null=True)
 
     def actualize(self, user: Optional[telegram.User]):
-        self.first_name = user.first_name
-        self.last_name = user.last_name
-        self.username = user.username
-        self.language_code = user.language_code
-        self.last_activity = dt.datetime.now()
+        self.update_changed_fields(
+            first_name=user.first_name,
+            last_name=user.last_name,
+            username=user.username,
+            language_code=user.language_code,
+        )
 
-        self.save()
+        # Время активности записывается в базу пачками в фоне
+        self.last_activity = dt.datetime.now()
+        last_activity_buffer.add(self)
 
     @classmethod
     def get_from(cls, user: Optional[telegram.User]) -> Optional["User"]:
         if not user:
             return
 
+        user_db = identity_cache.get(cls, user.id)
+        if user_db:
+            return user_db
+
         user_db = cls.get_or_none(cls.id == user.id)
         if not user_db:
             user_db = cls.create(
@@ -200,28 +410,31 @@ class User(BaseModel):
                 username=user.username,
                 language_code=user.language_code,
             )
+            Counter.increment(Counter.USERS)
+
+        identity_cache.add(user_db)
         return user_db
 
-    def get_total_quotes(self, with_comics=False) -> int:
-        query = Request.get_all_quote_id_by_user(self.id).distinct()
-        if not with_comics:
-            return query.count()
+    def get_stats(self) -> "UserStats":
+        return UserStats.get_for(self.id)
 
-        return Quote.get_all_with_comics(
-            where=Quote.id.in_(query)
-        ).count()
+    def get_total_quotes(self, with_comics=False) -> int:
+        stats = self.get_stats()
+        return stats.quotes_with_comics if with_comics else stats.quotes
 
     def get_user_unique_random(
         self,
         years: List[int] = None,
         limit=QUOTES_LIMIT,
         filter_quote_by_max_length_text: int = None,
+        exclude_ids: Container[int] = (),
     ) -> List["Quote"]:
         return Quote.get_user_unique_random(
             self,
             years=years,
             limit=limit,
             filter_quote_by_max_length_text=filter_quote_by_max_length_text,
+            exclude_ids=exclude_ids,
         )
 
     def get_years_of_quotes(self) -> Dict[int, bool]:
@@ -256,12 +469,12 @@ class User(BaseModel):
 
         self.settings.set_filter_quote_by_max_length_text(limit)
 
-    def find_quote_ids(self, regex: str, case_insensitive=True) -> List[int]:
+    def find_quote_ids(self, text: str, case_insensitive=True) -> List[int]:
         user_quotes = Quote.id.in_(
-            Request.get_all_quote_id_by_user(self).distinct()
+            Request.get_all_distinct_quote_id_by_user(self)
         )
-        return Quote.find(
-            regex,
+        return Quote.find_by_query(
+            text,
             case_insensitive,
             where=user_quotes,
         )
@@ -273,16 +486,34 @@ class User(BaseModel):
         items_per_page: int = ITEMS_PER_PAGE,
         order_by: Field = None,
     ) -> List["User"]:
+        """
+        Пользователи страницы вместе с количеством полученных цитат (атрибут total_quotes)
+        """
+
         if not order_by:
             order_by = cls.last_activity.desc()
 
-        return cls.paginating(
-            page=page,
-            items_per_page=items_per_page,
-            order_by=order_by
+        # Пока строки UserStats нет, количество считается по Request в том же запросе,
+        # а не отдельным UserStats.get_for на каждого пользователя
+        quotes_from_requests = (
+            Request
+            .select(fn.COUNT(Request.quote.distinct()))
+            .where(Request.user == cls.id)
         )
+        query = (
+            cls
+            .select(
+                cls,
+                fn.COALESCE(UserStats.quotes, quotes_from_requests).alias("total_quotes"),
+            )
+            .join(UserStats, JOIN.LEFT_OUTER, on=(UserStats.user == cls.id))
+            .order_by(order_by)
+            .paginate(page, items_per_page)
+            .objects()
+        )
+        return list(query)
 
-    def get_short_title(self) -> str:
+    def get_short_title(self, total_quotes: int = None) -> str:
         full_name = self.first_name.strip()
         if self.last_name:
             full_name += " " + self.last_name.strip()
@@ -299,7 +530,10 @@ class User(BaseModel):
 
         last_activity = get_date_time_str(self.last_activity)
 
-        return f"{full_name!r}, last_activity: {last_activity}, quotes: {self.get_total_quotes()}"
+        if total_quotes is None:
+            total_quotes = self.get_total_quotes()
+
+        return f"{full_name!r}, last_activity: {last_activity}, quotes: {total_quotes}"
 
 
 # SOURCE: https://core.telegram.org/bots/api#chat
@@ -313,21 +547,28 @@ class Chat(BaseModel):
     last_activity = DateTimeField(default=dt.datetime.now)
 
     def actualize(self, chat: Optional[telegram.Chat]):
-        self.type = chat.type
-        self.title = chat.title
-        self.username = chat.username
-        self.first_name = chat.first_name
-        self.last_name = chat.last_name
-        self.description = chat.description
-        self.last_activity = dt.datetime.now()
+        self.update_changed_fields(
+            type=chat.type,
+            title=chat.title,
+            username=chat.username,
+            first_name=chat.first_name,
+            last_name=chat.last_name,
+            description=chat.description,
+        )
 
-        self.save()
+        # Время активности записывается в базу пачками в фоне
+        self.last_activity = dt.datetime.now()
+        last_activity_buffer.add(self)
 
     @classmethod
     def get_from(cls, chat: Optional[telegram.Chat]) -> Optional["Chat"]:
         if not chat:
             return
 
+        chat_db = identity_cache.get(cls, chat.id)
+        if chat_db:
+            return chat_db
+
         chat_db = cls.get_or_none(cls.id == chat.id)
         if not chat_db:
             chat_db = cls.create(
@@ -339,6 +580,8 @@ class Chat(BaseModel):
                 last_name=chat.last_name,
                 description=chat.description,
             )
+
+        identity_cache.add(chat_db)
         return chat_db
 
     @classmethod
@@ -349,17 +592,29 @@ class Chat(BaseModel):
         order_by: Field = None,
         filters: Iterable = None,
     ) -> List["Chat"]:
+        """
+        Чаты страницы вместе с количеством их запросов (атрибут requests_count) одним запросом
+        """
+
         if not order_by:
             order_by = cls.last_activity.desc()
 
-        return cls.paginating(
-            page=page,
-            items_per_page=items_per_page,
-            order_by=order_by,
-            filters=filters,
+        page_ids = cls.select(cls.id)
+        if filters:
+            page_ids = page_ids.filter(*filters)
+        page_ids = page_ids.order_by(order_by).paginate(page, items_per_page)
+
+        query = (
+            cls
+            .select(cls, fn.COUNT(Request.id).alias("requests_count"))
+            .join(Request, JOIN.LEFT_OUTER, on=(Request.chat == cls.id))
+            .where(cls.id.in_(page_ids))
+            .group_by(cls.id)
+            .order_by(order_by)
         )
+        return list(query)
 
-    def get_short_title_for_group(self) -> str:
+    def get_short_title_for_group(self, requests: int = None) -> str:
         # NOTE: Была проблема с арабскими буквами в имени из-за чего разворачивало весь текст справа на лево
         title = self.title.strip() if self.title else ""
         title = replace_bad_symbols(title)
@@ -375,8 +630,8 @@ class Chat(BaseModel):
 
         last_activity = get_date_time_str(self.last_activity)
 
-        query_all_requests = Request.select().where(Request.chat == self)
-        requests = query_all_requests.count()
+        if requests is None:
+            requests = Request.select().where(Request.chat == self).count()
 
         return f"{title!r}, type: {self.type}, last_activity: {last_activity}, requests: {requests}"
 
@@ -387,22 +642,46 @@ class Quote(BaseModel):
     date = DateField()
     rating = IntegerField()
     modification_date = DateField(default=dt.date.today)
+    year = IntegerField(null=True)
+    text_length = IntegerField(null=True, index=True)
+    comics_count = IntegerField(default=0)
+
+    # Хэш текста, чтобы при обновлении цитат не сравнивать тексты целиком
+    text_sha256 = TextField(null=True)
+
+    # Дата последней проверки цитаты на сайте, modification_date меняется только при изменениях
+    refresh_date = DateField(null=True)
+
+    class Meta:
+        indexes = (
+            (("year", "text_length"), False),
+        )
 
     @property
     def date_str(self) -> str:
         return self.date.strftime(DATE_FORMAT_QUOTE)
 
     def has_comics(self) -> bool:
-        return bool(self.get_comics())
+        return self.comics_count > 0
 
     def get_comics(self) -> List["Comics"]:
         return list(self.comics)
 
     def get_comics_urls(self) -> List[str]:
+        if not self.has_comics():
+            return []
+
         return [comics.url for comics in self.comics]
 
     def get_comics_file_names(self) -> List[str]:
-        return [comics.file_name for comics in self.comics]
+        if not self.has_comics():
+            return []
+
+        return [comics.file_name for comics in self.comics if comics.file_name]
+
+    @staticmethod
+    def get_text_sha256(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
     def get_proxy(self) -> bash_im.Quote:
         return bash_im.Quote(
@@ -419,18 +698,176 @@ class Quote(BaseModel):
                 text=quote.text,
                 date=quote.date,
                 rating=quote.rating,
+                year=quote.date.year,
+                text_length=len(quote.text),
+                text_sha256=cls.get_text_sha256(quote.text),
             )
+            quote_pool.add(quote_db.id, quote_db.year, quote_db.text_length)
+            QuoteTextIndex.add_to_all(quote_db.id, quote_db.text)
+            QuoteYearStats.increment(quote_db.year, quotes=1)
 
-        for url in quote.comics_urls:
-            comics_db = Comics.get_or_none(Comics.url == url)
-            if not comics_db:
-                Comics.create(
-                    url=url,
-                    quote=quote_db
-                )
+        quote_db.add_comics(quote.comics_urls)
 
         return quote_db
 
+    @classmethod
+    def bulk_get_from(cls, quotes: List[bash_im.Quote]) -> List[int]:
+        """
+        Пакетное добавление цитат и их комиксов одной транзакцией через INSERT ... ON CONFLICT.
+        Уже существующие цитаты не меняются, как и в get_from. Вернет id новых цитат
+        """
+
+        quote_by_id = {quote.id: quote for quote in quotes}
+        if not quote_by_id:
+            return []
+
+        with db_batch.atomic("IMMEDIATE"):
+            existing_ids = set()
+            for batch in chunked(quote_by_id, 500):
+                query = cls.select(cls.id).where(cls.id.in_(batch)).bind(db_batch)
+                existing_ids.update(quote_id for quote_id, in query.tuples())
+
+            new_rows = [
+                dict(
+                    id=quote.id,
+                    url=quote.url,
+                    text=quote.text,
+                    date=quote.date,
+                    rating=quote.rating,
+                    year=quote.date.year,
+                    text_length=len(quote.text),
+                    text_sha256=cls.get_text_sha256(quote.text),
+                )
+                for quote in quote_by_id.values()
+                if quote.id not in existing_ids
+            ]
+            for batch in chunked(new_rows, 100):
+                db_batch.execute(cls.insert_many(batch).on_conflict_ignore())
+
+            QuoteTextIndex.add_many_to_all(
+                [(row["id"], row["text"]) for row in new_rows],
+                database=db_batch,
+            )
+            for year, number in CollectionsCounter(row["year"] for row in new_rows).items():
+                QuoteYearStats.increment(year, quotes=number, database=db_batch)
+
+            Comics.bulk_add(
+                {quote.id: quote.comics_urls for quote in quote_by_id.values()},
+                database=db_batch,
+            )
+
+        for row in new_rows:
+            quote_pool.add(row["id"], row["year"], row["text_length"])
+
+        return [row["id"] for row in new_rows]
+
+    @classmethod
+    def bulk_update_from(cls, quotes: List[bash_im.Quote]) -> Tuple[List[int], List[int]]:
+        """
+        Пакетное обновление уже существующих цитат по цитатам с сайта одной транзакцией.
+        Изменение текста определяется по text_sha256. modification_date становится текущей
+        датой только у цитат с измененным текстом или рейтингом, refresh_date - у всех.
+        Вернет id цитат с измененным текстом или рейтингом и id цитат с новыми комиксами
+        """
+
+        quote_by_id = {quote.id: quote for quote in quotes}
+        if not quote_by_id:
+            return [], []
+
+        with db_batch.atomic("IMMEDIATE"):
+            text_changed_ids = []
+            rating_changed_ids = []
+            for batch in chunked(quote_by_id, 500):
+                query = (
+                    cls.select(cls.id, cls.text_sha256, cls.rating)
+                    .where(cls.id.in_(batch))
+                    .bind(db_batch)
+                )
+                for quote_id, text_sha256, rating in query.tuples():
+                    quote = quote_by_id[quote_id]
+                    if text_sha256 != cls.get_text_sha256(quote.text):
+                        text_changed_ids.append(quote_id)
+                    if rating != quote.rating:
+                        rating_changed_ids.append(quote_id)
+
+            # Старые тексты нужны только для удаления из индексов
+            old_text_by_id = dict()
+            for batch in chunked(text_changed_ids, 500):
+                query = cls.select(cls.id, cls.text).where(cls.id.in_(batch)).bind(db_batch)
+                old_text_by_id.update(query.tuples())
+
+            QuoteTextIndex.update_many_in_all(
+                [
+                    (quote_id, old_text, quote_by_id[quote_id].text)
+                    for quote_id, old_text in old_text_by_id.items()
+                ],
+                database=db_batch,
+            )
+
+            for batch in chunked(text_changed_ids, 100):
+                texts = [(quote_id, quote_by_id[quote_id].text) for quote_id in batch]
+                query = (
+                    cls.update(
+                        text=Case(cls.id, texts),
+                        text_length=Case(
+                            cls.id, [(quote_id, len(text)) for quote_id, text in texts]
+                        ),
+                        text_sha256=Case(
+                            cls.id,
+                            [(quote_id, cls.get_text_sha256(text)) for quote_id, text in texts],
+                        ),
+                    )
+                    .where(cls.id.in_(batch))
+                )
+                db_batch.execute(query)
+
+            for batch in chunked(rating_changed_ids, 100):
+                ratings = [(quote_id, quote_by_id[quote_id].rating) for quote_id in batch]
+                db_batch.execute(
+                    cls.update(rating=Case(cls.id, ratings)).where(cls.id.in_(batch))
+                )
+
+            today = dt.date.today()
+            changed_ids = sorted(set(text_changed_ids) | set(rating_changed_ids))
+            for batch in chunked(changed_ids, 500):
+                db_batch.execute(
+                    cls.update(modification_date=today).where(cls.id.in_(batch))
+                )
+
+            for batch in chunked(quote_by_id, 500):
+                db_batch.execute(
+                    cls.update(refresh_date=today).where(cls.id.in_(batch))
+                )
+
+            added_comics_by_quote_id = Comics.bulk_add(
+                {quote.id: quote.comics_urls for quote in quote_by_id.values()},
+                database=db_batch,
+            )
+
+        for quote_id in text_changed_ids:
+            quote = quote_by_id[quote_id]
+            quote_pool.add(quote_id, quote.date.year, len(quote.text))
+
+        return changed_ids, list(added_comics_by_quote_id)
+
+    def add_comics(self, urls: List[str]) -> int:
+        """
+        Добавление отсутствующих в базе комиксов цитаты. Вернет количество добавленных
+        """
+
+        if not urls:
+            return 0
+
+        # Первые комиксы цитаты определяются по comics_count внутри транзакции, поэтому
+        # статистика обновится один раз, даже если цитату одновременно записывает RequestBuffer
+        with db_batch.atomic("IMMEDIATE"):
+            added_by_quote_id = Comics.bulk_add({self.id: urls}, database=db_batch)
+
+        added = added_by_quote_id.get(self.id, 0)
+        self.comics_count += added
+
+        return added
+
     @classmethod
     def get_random(cls, limit=QUOTES_LIMIT) -> List["Quote"]:
         return list(cls.select().order_by(fn.Random()).limit(limit))
@@ -442,24 +879,36 @@ class Quote(BaseModel):
         years: List[int] = None,
         limit=QUOTES_LIMIT,
         filter_quote_by_max_length_text: int = None,
+        exclude_ids: Container[int] = (),
     ) -> List["Quote"]:
-        sub_query = Request.get_all_quote_id_by_user(user_id).distinct()
+        if isinstance(user_id, User):
+            user_id = user_id.id
 
-        where = cls.id.not_in(sub_query)
-        if years:
-            fn_year = fn.strftime("%Y", cls.date).cast("INTEGER")
-            where = where & fn_year.in_(years)
+        quote_ids = quote_pool.get_random_unseen(
+            seen=seen_quotes.get(user_id),
+            limit=limit,
+            years=years,
+            max_text_length=filter_quote_by_max_length_text,
+            exclude=exclude_ids,
+        )
+        return cls.get_by_ids(quote_ids)
 
-        if filter_quote_by_max_length_text:
-            where = where & (fn.LENGTH(cls.text) <= filter_quote_by_max_length_text)
+    @classmethod
+    def get_by_ids(cls, quote_ids: List[int]) -> List["Quote"]:
+        if not quote_ids:
+            return []
 
-        query = (
-            cls.select()
-            .where(where)
-            .order_by(fn.Random())
-            .limit(limit)
-        )
-        return list(query)
+        # Порядок цитат соответствует порядку их id
+        quote_by_id = {
+            quote.id: quote
+            for quote in cls.select().where(cls.id.in_(quote_ids))
+        }
+        return [quote_by_id[quote_id] for quote_id in quote_ids if quote_id in quote_by_id]
+
+    @classmethod
+    def get_pool_items(cls) -> List[Tuple[int, int, int]]:
+        query = cls.select(cls.id, cls.year, cls.text_length)
+        return list(query.tuples())
 
     @classmethod
     def get_number_of_unique_quotes(
@@ -467,58 +916,86 @@ class Quote(BaseModel):
         user_id: Union[int, User],
         years: List[int] = None,
     ) -> int:
-        sub_query = Request.get_all_quote_id_by_user(user_id).distinct()
+        sub_query = Request.get_all_distinct_quote_id_by_user(user_id)
 
         where = cls.id.not_in(sub_query)
         if years:
-            fn_year = fn.strftime("%Y", cls.date).cast("INTEGER")
-            where = where & fn_year.in_(years)
+            where = where & cls.year.in_(years)
 
-        query = cls.select().where(where)
+        query = cls.select(cls.id).where(where)
         return query.count()
 
+    @classmethod
+    def get_stale(cls, refresh_date: dt.date) -> ModelSelect:
+        """
+        Цитаты, не проверявшиеся на сайте с refresh_date включительно. Цитаты, которые
+        еще ни разу не проверялись, считаются проверенными в дату modification_date
+        """
+
+        return cls.select().where(
+            fn.COALESCE(cls.refresh_date, cls.modification_date) <= refresh_date
+        )
+
+    @classmethod
+    def get_stale_ids(
+        cls,
+        refresh_date: dt.date,
+        after_id: int = 0,
+        limit: int = 100,
+    ) -> List[int]:
+        """
+        Id цитат из get_stale по возрастанию id
+        """
+
+        query = (
+            cls.get_stale(refresh_date)
+            .select(cls.id)
+            .where(cls.id > after_id)
+            .order_by(cls.id)
+            .limit(limit)
+        )
+        return [quote_id for quote_id, in query.tuples()]
+
     @classmethod
     def get_all_with_comics(cls, where: ModelSelect = None) -> ModelSelect:
-        query = cls.select()
+        query = cls.select().where(cls.comics_count > 0)
         if where:
             query = query.where(where)
 
-        return (
-            query.join(Comics, JOIN.LEFT_OUTER)
-            .group_by(cls)
-            .having(fn.COUNT(Comics.id) > 0)
-        )
+        return query
 
     @classmethod
     def get_year_by_counts(cls) -> List[Tuple[int, int]]:
-        fn_year = fn.strftime("%Y", cls.date).cast("INTEGER")
         query = (
             cls
             .select(
-                fn_year.alias("year"),
+                cls.year,
                 fn.count(cls.id).alias("count")
             )
-            .group_by(fn_year)
-            .order_by(fn_year)
+            .group_by(cls.year)
+            .order_by(cls.year)
         )
 
         return [(row.year, row.count) for row in query]
 
     @classmethod
     def get_years(cls) -> List[int]:
-        fn_year = fn.strftime("%Y", cls.date).cast("INTEGER")
         query = (
             cls
-            .select(
-                fn_year.alias("year")
-            )
+            .select(cls.year)
             .distinct()
-            .order_by(fn_year)
+            .order_by(cls.year)
         )
         return [row.year for row in query]
 
     @classmethod
-    def find(cls, regex: str, case_insensitive=True, where: ModelSelect = None) -> List[int]:
+    def find(
+        cls,
+        regex: str,
+        case_insensitive=True,
+        where: ModelSelect = None,
+        use_index=True,
+    ) -> List[int]:
         if case_insensitive:
             regex = f"(?i){regex}"
 
@@ -526,13 +1003,49 @@ class Quote(BaseModel):
         if where:
             expr &= where
 
+        query = cls.select(cls.id)
+
+        # Регулярное выражение проверяется только на цитатах, в которых
+        # по триграммному индексу нашлись все обязательные подстроки
+        literals = get_required_literals(regex)
+        if use_index and literals and QuoteTrigram.is_available():
+            trigram_query = " AND ".join(
+                '"' + literal.replace('"', '""') + '"' for literal in literals
+            )
+            query = query.join(QuoteTrigram, on=(QuoteTrigram.rowid == cls.id))
+            expr &= QuoteTrigram.match(trigram_query)
+
         return [
             quote.id
-            for quote in cls
-                .select(cls.id)
+            for quote in query
                 .where(expr)
+                .order_by(cls.id)
         ]
 
+    @classmethod
+    def search(cls, text: str, where: ModelSelect = None) -> List[int]:
+        expr = QuoteSearch.match(get_full_text_query(text))
+        if where:
+            expr &= where
+
+        query = (
+            cls
+            .select(cls.id)
+            .join(QuoteSearch, on=(QuoteSearch.rowid == cls.id))
+            .where(expr)
+            .order_by(cls.id)
+        )
+        return [quote_id for quote_id, in query.tuples()]
+
+    @classmethod
+    def find_by_query(cls, text: str, case_insensitive=True, where: ModelSelect = None) -> List[int]:
+        # По умолчанию поиск подстроки или регулярного выражения, по словам - только явно.
+        # Индекс слов не различает регистр, поэтому поиск с учетом регистра идет через find
+        if case_insensitive and QuoteSearch.is_available() and is_full_text_query(text):
+            return cls.search(text, where)
+
+        return cls.find(text, case_insensitive, where)
+
     @classmethod
     def paginating_by_date(
         cls,
@@ -576,17 +1089,276 @@ class Quote(BaseModel):
         return (
             self.__class__.__name__
             + f"(id={self.id}, url={self.url!r}, text={shorten(self.text)!r}, "
-            f"date={self.date}, rating={self.rating}, comics_number={len(self.get_comics())})"
+            f"date={self.date}, rating={self.rating}, comics_number={self.comics_count})"
+        )
+
+
+class QuoteTextIndex(FTS5Model):
+    """
+    Базовый класс индексов FTS5 по тексту цитат. Само содержимое хранится в таблице quote
+    """
+
+    rowid = RowIDField()
+    text = SearchField()
+
+    class Meta:
+        database = db
+
+    @classmethod
+    def is_available(cls) -> bool:
+        return IS_FTS5_INSTALLED
+
+    @classmethod
+    def add(cls, quote_id: int, text: str):
+        if not cls.is_available():
+            return
+
+        cls.insert(rowid=quote_id, text=text).execute()
+
+    @classmethod
+    def remove(cls, quote_id: int, text: str):
+        if not cls.is_available():
+            return
+
+        # Для индекса с внешним содержимым удаление выполняется специальной командой
+        table_name = cls._meta.table_name
+        cls._meta.database.execute_sql(
+            f"INSERT INTO {table_name}({table_name}, rowid, text) VALUES('delete', ?, ?)",
+            (quote_id, text),
         )
 
+    @classmethod
+    def update_text(cls, quote_id: int, old_text: str, new_text: str):
+        cls.remove(quote_id, old_text)
+        cls.add(quote_id, new_text)
+
+    @classmethod
+    def create_index(cls):
+        """
+        Создание индекса. Индекс с внешним содержимым создается пустым, поэтому
+        при уже имеющихся цитатах он сразу заполняется из таблицы quote
+        """
+
+        # Через db запись только ставится в очередь, поэтому проверка и заполнение
+        # идут через синхронное соединение
+        table_name = cls._meta.table_name
+        with db_batch.bind_ctx([cls]), db_batch.atomic("IMMEDIATE"):
+            cls.create_table()
+
+            is_empty = not db_batch.execute_sql(
+                f"SELECT EXISTS(SELECT 1 FROM {table_name}_docsize)"
+            ).fetchone()[0]
+            # В новой базе таблица quote может быть еще не создана очередью записи
+            has_quotes = db_batch.table_exists(Quote._meta.table_name) and db_batch.execute_sql(
+                f"SELECT EXISTS(SELECT 1 FROM {Quote._meta.table_name})"
+            ).fetchone()[0]
+            if is_empty and has_quotes:
+                log.info(f"Rebuilding the {table_name} index")
+                db_batch.execute_sql(f"INSERT INTO {table_name}({table_name}) VALUES('rebuild')")
+
+    @classmethod
+    def get_inherited_models(cls) -> List[Type["QuoteTextIndex"]]:
+        return sorted(cls.__subclasses__(), key=lambda x: x.__name__)
+
+    @classmethod
+    def get_available_models(cls) -> List[Type["QuoteTextIndex"]]:
+        return [sub_cls for sub_cls in cls.get_inherited_models() if sub_cls.is_available()]
+
+    @classmethod
+    def add_many_to_all(cls, items: List[Tuple[int, str]], database: SqliteExtDatabase = None):
+        for sub_cls in cls.get_available_models():
+            for batch in chunked(items, 100):
+                query = sub_cls.insert_many(
+                    [dict(rowid=quote_id, text=text) for quote_id, text in batch]
+                )
+                query.execute(database)
+
+    @classmethod
+    def add_to_all(cls, quote_id: int, text: str):
+        for sub_cls in cls.get_inherited_models():
+            sub_cls.add(quote_id, text)
+
+    @classmethod
+    def update_text_in_all(cls, quote_id: int, old_text: str, new_text: str):
+        for sub_cls in cls.get_inherited_models():
+            sub_cls.update_text(quote_id, old_text, new_text)
+
+    @classmethod
+    def update_many_in_all(
+        cls,
+        items: List[Tuple[int, str, str]],
+        database: SqliteExtDatabase = None,
+    ):
+        """
+        Замена текстов в индексах, items: (id цитаты, старый текст, новый текст)
+        """
+
+        database = database or db
+        for sub_cls in cls.get_available_models():
+            table_name = sub_cls._meta.table_name
+            for batch in chunked(items, 100):
+                database.execute_sql(
+                    f"INSERT INTO {table_name}({table_name}, rowid, text) VALUES "
+                    + ", ".join(["('delete', ?, ?)"] * len(batch)),
+                    [value for quote_id, old_text, _ in batch for value in (quote_id, old_text)],
+                )
+                query = sub_cls.insert_many(
+                    [dict(rowid=quote_id, text=new_text) for quote_id, _, new_text in batch]
+                )
+                query.execute(database)
+
+
+class QuoteSearch(QuoteTextIndex):
+    """
+    Полнотекстовый индекс по словам
+    """
+
+    class Meta:
+        options = {
+            "content": Quote,
+            "content_rowid": Quote.id,
+            "tokenize": "unicode61 remove_diacritics 2",
+        }
+
+
+class QuoteTrigram(QuoteTextIndex):
+    """
+    Триграммный индекс для отбора кандидатов при поиске по регулярным выражениям
+    """
+
+    class Meta:
+        options = {
+            "content": Quote,
+            "content_rowid": Quote.id,
+            "tokenize": "trigram",
+        }
+
+    @classmethod
+    def is_available(cls) -> bool:
+        # Токенизатор trigram появился в SQLite 3.34.0
+        return IS_FTS5_INSTALLED and sqlite3.sqlite_version_info >= (3, 34, 0)
+
 
 class Comics(BaseModel):
     url = TextField(unique=True)
     quote = ForeignKeyField(Quote, backref="comics")
 
+    # Идентификатор загруженного в Telegram файла, чтобы не отправлять файл повторно
+    file_id = TextField(null=True)
+
+    # Скачанный файл комикса в DIR_COMICS
+    file_name = TextField(null=True)
+    file_size = IntegerField(null=True)
+    file_sha256 = TextField(null=True)
+
     def get_comics_id(self) -> str:
         return self.url.rstrip("/").split("/")[-1]
 
+    def get_file_path(self) -> Optional[Path]:
+        if not self.file_name:
+            return
+
+        return DIR_COMICS / self.file_name
+
+    def set_file(self, file_path: Path):
+        data = file_path.read_bytes()
+        self.update_changed_fields(
+            file_name=file_path.name,
+            file_size=len(data),
+            file_sha256=hashlib.sha256(data).hexdigest(),
+        )
+
+    @classmethod
+    def add_files(cls, quote_id: int, file_names: List[Union[str, Path]]):
+        """
+        Запись скачанных файлов комиксов цитаты. Имя файла: quote<id цитаты>_<id комикса>.png
+        """
+
+        comics_by_id = {
+            comics.get_comics_id(): comics
+            for comics in cls.get_all_by_quote(quote_id)
+        }
+        for file_path in map(Path, file_names):
+            comics_id = file_path.stem.split("_", maxsplit=1)[-1]
+            comics = comics_by_id.get(comics_id)
+
+            # Уже записанные файлы повторно не читаются
+            if comics and comics.file_name != file_path.name:
+                comics.set_file(file_path)
+
+    def set_file_id(self, file_id: Optional[str]):
+        if self.file_id == file_id:
+            return
+
+        self.file_id = file_id
+        self.save(only=[Comics.file_id])
+
+    @classmethod
+    def bulk_add(
+        cls,
+        urls_by_quote_id: Dict[int, List[str]],
+        database: SqliteExtDatabase,
+    ) -> Dict[int, int]:
+        """
+        Добавление отсутствующих в базе комиксов цитат с обновлением Quote.comics_count и статистики.
+        Вызывается внутри транзакции database. Вернет количество добавленных комиксов по id цитат
+        """
+
+        urls = {
+            url: quote_id
+            for quote_id, quote_urls in urls_by_quote_id.items()
+            for url in quote_urls
+        }
+        if not urls:
+            return dict()
+
+        existing_urls = set()
+        for batch in chunked(urls, 500):
+            query = cls.select(cls.url).where(cls.url.in_(batch)).bind(database)
+            existing_urls.update(url for url, in query.tuples())
+
+        new_rows = [
+            dict(url=url, quote=quote_id)
+            for url, quote_id in urls.items()
+            if url not in existing_urls
+        ]
+        if not new_rows:
+            return dict()
+
+        for batch in chunked(new_rows, 100):
+            database.execute(cls.insert_many(batch).on_conflict_ignore())
+
+        added_by_quote_id = CollectionsCounter(row["quote"] for row in new_rows)
+
+        # Цитаты, у которых до этого не было комиксов
+        query = (
+            Quote
+            .select(Quote.id, Quote.year)
+            .where(Quote.id.in_(list(added_by_quote_id)) & (Quote.comics_count == 0))
+            .bind(database)
+        )
+        first_comics = list(query.tuples())
+
+        for batch in chunked(added_by_quote_id.items(), 100):
+            query = (
+                Quote
+                .update(comics_count=Quote.comics_count + Case(Quote.id, batch))
+                .where(Quote.id.in_([quote_id for quote_id, _ in batch]))
+            )
+            database.execute(query)
+
+        for year, number in CollectionsCounter(year for _, year in first_comics).items():
+            QuoteYearStats.increment(year, quotes_with_comics=number, database=database)
+
+        for quote_id, _ in first_comics:
+            UserStats.on_quote_got_comics(quote_id, database=database)
+
+        return added_by_quote_id
+
+    @classmethod
+    def get_all_by_quote(cls, quote_id: int) -> List["Comics"]:
+        return list(cls.select().where(cls.quote == quote_id).order_by(cls.id))
+
     def __str__(self):
         return (
             self.__class__.__name__
@@ -604,6 +1376,12 @@ class Request(BaseModel):
     message = TextField(null=True)
     query_data = TextField(null=True)
 
+    class Meta:
+        indexes = (
+            (("user", "quote"), False),
+            (("user", "id"), False),
+        )
+
     @classmethod
     def get_all_quote_id_by_user(
         cls,
@@ -623,11 +1401,547 @@ class Request(BaseModel):
         )
         return query
 
+    @classmethod
+    def get_all_distinct_quote_id_by_user(cls, user_id: Union[int, User]) -> ModelSelect:
+        # Без сортировки запрос полностью покрывается индексом (user_id, quote_id)
+        return (
+            cls
+            .select(cls.quote_id)
+            .where(
+                cls.quote_id.is_null(False) & (cls.user_id == user_id)
+            )
+            .distinct()
+        )
+
+    @classmethod
+    def get_quote_positions_by_user(
+        cls,
+        user_id: Union[int, User],
+        quote_id: int,
+    ) -> List[int]:
+        """
+        Порядковые номера цитаты среди полученных пользователем цитат, считая от последней
+        """
+
+        # Номер каждого запроса пользователя с цитатой, считая от последнего, одним запросом
+        sub_query = (
+            cls
+            .select(
+                cls.quote_id,
+                (
+                    fn.ROW_NUMBER().over(
+                        partition_by=[cls.user_id],
+                        order_by=[cls.id.desc()],
+                    ) - 1
+                ).alias("position"),
+            )
+            .where(cls.quote_id.is_null(False) & (cls.user_id == user_id))
+        )
+        query = (
+            Select(from_list=[sub_query], columns=[sub_query.c.position])
+            .where(sub_query.c.quote_id == quote_id)
+            .order_by(sub_query.c.position)
+            .bind(cls._meta.database)
+        )
+        return [position for position, in query.tuples()]
+
+    @classmethod
+    def get_seen_quote_ids(cls, user_id: Union[int, User]) -> List[int]:
+        if isinstance(user_id, User):
+            user_id = user_id.id
+
+        # Сначала буфер, т.к. за время запроса к базе его строки могут в нее записаться
+        items = request_buffer.get_quote_ids(user_id)
+
+        query = cls.get_all_distinct_quote_id_by_user(user_id)
+        items += [quote_id for quote_id, in query.tuples()]
+        return items
+
     @classmethod
     def get_first_date_time(cls) -> dt.datetime:
         return cls.select().order_by(cls.id).first().date_time
 
 
+class UserStats(BaseModel):
+    """
+    Счетчики пользователя: уникальные полученные цитаты, из них с комиксами, запросы,
+    время первого и последнего запроса. Обновляются при записи Request из буфера
+    """
+
+    user = ForeignKeyField(User, primary_key=True)
+    quotes = IntegerField(default=0)
+    quotes_with_comics = IntegerField(default=0)
+    requests = IntegerField(default=0)
+    first_request = DateTimeField(null=True)
+    last_request = DateTimeField(null=True)
+
+    @classmethod
+    def get_for(cls, user_id: Union[int, User]) -> "UserStats":
+        if isinstance(user_id, User):
+            user_id = user_id.id
+
+        stats = cls.get_or_none(cls.user == user_id)
+        if stats:
+            return stats
+
+        # Строки еще нет, счетчики один раз считаются по Request. В той же транзакции,
+        # что и запись буфера запросов, чтобы ни один запрос не потерялся и не посчитался дважды
+        with db_batch.atomic("IMMEDIATE"):
+            requests, quotes, first_request, last_request = (
+                Request
+                .select(
+                    fn.COUNT(Request.id),
+                    fn.COUNT(Request.quote.distinct()),
+                    fn.MIN(Request.date_time),
+                    fn.MAX(Request.date_time),
+                )
+                .where(Request.user == user_id)
+                .bind(db_batch)
+                .tuples()
+                .get()
+            )
+            quotes_with_comics = (
+                Quote
+                .get_all_with_comics(
+                    where=Quote.id.in_(Request.get_all_distinct_quote_id_by_user(user_id))
+                )
+                .bind(db_batch)
+                .count()
+            )
+            db_batch.execute(
+                cls.insert(
+                    user=user_id,
+                    quotes=quotes,
+                    quotes_with_comics=quotes_with_comics,
+                    requests=requests,
+                    first_request=first_request,
+                    last_request=last_request,
+                ).on_conflict_ignore()
+            )
+
+        return cls.get(cls.user == user_id)
+
+    @classmethod
+    def update_from_requests(cls, items: List[Tuple[Dict, bool]], database: SqliteExtDatabase):
+        """
+        Обновление счетчиков по записываемым запросам: пары (строка Request, новая ли цитата для пользователя).
+        Обновляются только уже существующие строки, остальные посчитаются в get_for
+        """
+
+        new_quote_ids = {row["quote"] for row, is_new_quote in items if is_new_quote}
+        quote_ids_with_comics = set()
+        for batch in chunked(new_quote_ids, 500):
+            query = (
+                Quote
+                .select(Quote.id)
+                .where(Quote.id.in_(batch) & (Quote.comics_count > 0))
+                .bind(database)
+            )
+            quote_ids_with_comics.update(quote_id for quote_id, in query.tuples())
+
+        user_by_stats: Dict[int, Dict] = dict()
+        for row, is_new_quote in items:
+            user_id = row["user"]
+            if not user_id:
+                continue
+
+            stats = user_by_stats.setdefault(
+                user_id,
+                dict(
+                    quotes=0,
+                    quotes_with_comics=0,
+                    requests=0,
+                    first_request=row["date_time"],
+                    last_request=row["date_time"],
+                ),
+            )
+            stats["requests"] += 1
+            stats["first_request"] = min(stats["first_request"], row["date_time"])
+            stats["last_request"] = max(stats["last_request"], row["date_time"])
+
+            if is_new_quote:
+                stats["quotes"] += 1
+                if row["quote"] in quote_ids_with_comics:
+                    stats["quotes_with_comics"] += 1
+
+        for user_id, stats in user_by_stats.items():
+            query = (
+                cls
+                .update(
+                    quotes=cls.quotes + stats["quotes"],
+                    quotes_with_comics=cls.quotes_with_comics + stats["quotes_with_comics"],
+                    requests=cls.requests + stats["requests"],
+                    first_request=fn.COALESCE(cls.first_request, stats["first_request"]),
+                    last_request=stats["last_request"],
+                )
+                .where(cls.user == user_id)
+            )
+            database.execute(query)
+
+    @classmethod
+    def on_quote_got_comics(cls, quote_id: int, database: SqliteExtDatabase = None):
+        """
+        У цитаты появились первые комиксы: цитата с комиксами у всех, кто ее уже получал.
+        Вызывается из Comics.bulk_add в той же транзакции, где проверено, что комиксов
+        у цитаты еще не было
+        """
+
+        user_ids = (
+            Request
+            .select(Request.user)
+            .where((Request.quote == quote_id) & Request.user.is_null(False))
+            .distinct()
+        )
+        query = (
+            cls
+            .update(quotes_with_comics=cls.quotes_with_comics + 1)
+            .where(cls.user.in_(user_ids))
+        )
+        query.execute(database)
+
+
+class QuoteCache(BaseModel):
+    """
+    Сохраненный кэш цитат пользователя (context.user_data["quotes"]), чтобы
+    после перезапуска бота не заполнять кэши всех пользователей заново
+    """
+
+    user = ForeignKeyField(User, unique=True)
+    quote_ids = TextField(default="")
+    modification_date_time = DateTimeField(default=dt.datetime.now)
+
+    def get_quote_ids(self) -> List[int]:
+        if not self.quote_ids:
+            return []
+
+        return list(map(int, self.quote_ids.split(",")))
+
+    @classmethod
+    def get_quotes(cls, user_id: Union[int, User]) -> List[Quote]:
+        if isinstance(user_id, User):
+            user_id = user_id.id
+
+        quote_cache = cls.get_or_none(cls.user == user_id)
+        if not quote_cache:
+            return []
+
+        # Цитаты, полученные уже после сохранения кэша, пропускаются
+        seen = seen_quotes.get(user_id)
+        quote_ids = [
+            quote_id for quote_id in quote_cache.get_quote_ids()
+            if quote_id not in seen
+        ]
+        return Quote.get_by_ids(quote_ids)
+
+    @classmethod
+    def set_quotes(cls, user_id: Union[int, User], quotes: List[Quote]):
+        quote_ids = ",".join(str(quote.id) for quote in quotes)
+        modification_date_time = dt.datetime.now()
+
+        (
+            cls.insert(
+                user=user_id,
+                quote_ids=quote_ids,
+                modification_date_time=modification_date_time,
+            )
+            .on_conflict(
+                conflict_target=[cls.user],
+                update={
+                    cls.quote_ids: quote_ids,
+                    cls.modification_date_time: modification_date_time,
+                },
+            )
+            .execute()
+        )
+
+
+class QuoteYearStats(BaseModel):
+    """
+    Количество цитат и цитат с комиксами по годам. Обновляется при добавлении
+    цитат и комиксов, а также периодически пересчитывается в reconcile_stats
+    """
+
+    year = IntegerField(primary_key=True)
+    quotes = IntegerField(default=0)
+    quotes_with_comics = IntegerField(default=0)
+
+    @classmethod
+    def increment(
+        cls,
+        year: int,
+        quotes: int = 0,
+        quotes_with_comics: int = 0,
+        database: SqliteExtDatabase = None,
+    ):
+        query = (
+            cls.insert(
+                year=year,
+                quotes=quotes,
+                quotes_with_comics=quotes_with_comics,
+            )
+            .on_conflict(
+                conflict_target=[cls.year],
+                update={
+                    cls.quotes: cls.quotes + quotes,
+                    cls.quotes_with_comics: cls.quotes_with_comics + quotes_with_comics,
+                },
+            )
+        )
+        query.execute(database)
+
+    @classmethod
+    def get_all(cls) -> List["QuoteYearStats"]:
+        return list(cls.select().order_by(cls.year))
+
+    @classmethod
+    def get_totals(cls) -> Tuple[int, int]:
+        """
+        Всего цитат и цитат с комиксами
+        """
+
+        quotes, quotes_with_comics = (
+            cls
+            .select(
+                fn.COALESCE(fn.SUM(cls.quotes), 0),
+                fn.COALESCE(fn.SUM(cls.quotes_with_comics), 0),
+            )
+            .tuples()
+            .get()
+        )
+        return quotes, quotes_with_comics
+
+    @classmethod
+    def reconcile(cls, database: SqliteExtDatabase):
+        query = (
+            Quote
+            .select(
+                Quote.year,
+                fn.COUNT(Quote.id.distinct()),
+                fn.COUNT(Comics.quote.distinct()),
+            )
+            .join(Comics, JOIN.LEFT_OUTER)
+            .group_by(Quote.year)
+        )
+
+        database.execute(cls.delete())
+        database.execute(
+            cls.insert_from(query, [cls.year, cls.quotes, cls.quotes_with_comics])
+        )
+
+
+class Counter(BaseModel):
+    """
+    Именованные счетчики, чтобы не делать count() по большим таблицам
+    """
+
+    USERS = "users"
+    REQUESTS = "requests"
+
+    name = TextField(primary_key=True)
+    value = IntegerField(default=0)
+
+    @classmethod
+    def increment(cls, name: str, value: int = 1, database: SqliteExtDatabase = None):
+        query = (
+            cls.insert(name=name, value=value)
+            .on_conflict(
+                conflict_target=[cls.name],
+                update={cls.value: cls.value + value},
+            )
+        )
+        query.execute(database or db)
+
+    @classmethod
+    def get_value(cls, name: str) -> int:
+        counter = cls.get_or_none(cls.name == name)
+        return counter.value if counter else 0
+
+    @classmethod
+    def reconcile(cls, database: SqliteExtDatabase):
+        for name, model_cls in [(cls.USERS, User), (cls.REQUESTS, Request)]:
+            value = model_cls.select().count(database)
+            database.execute(
+                cls.replace(name=name, value=value)
+            )
+
+
+def reconcile_stats():
+    """
+    Пересчет таблиц статистики по исходным таблицам.
+    Исправляет возможные расхождения счетчиков, например, после ручных правок базы
+    """
+
+    with db_batch.atomic("IMMEDIATE"):
+        QuoteYearStats.reconcile(db_batch)
+        Counter.reconcile(db_batch)
+
+
+class CrawlPage(BaseModel):
+    """
+    Очередь страниц архива bash.im для ArchiveCrawler: состояние каждой страницы
+    в текущем проходе, число попыток и время следующей попытки после ошибки
+    """
+
+    STATUS_PENDING = "pending"
+    STATUS_IN_PROGRESS = "in_progress"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+
+    page = IntegerField(primary_key=True)
+    status = TextField(default=STATUS_PENDING, index=True)
+    attempts = IntegerField(default=0)
+    next_attempt_date_time = DateTimeField(default=dt.datetime.now)
+    quotes = IntegerField(default=0)
+    new_quotes = IntegerField(default=0)
+    last_error = TextField(null=True)
+    modification_date_time = DateTimeField(default=dt.datetime.now)
+
+    @classmethod
+    def add_pages(cls, pages: Iterable[int], status: str = STATUS_PENDING) -> int:
+        """
+        Добавление в очередь страниц, которых в ней еще нет. Вернет количество добавленных
+        """
+
+        pages = list(pages)
+        with db_batch.atomic("IMMEDIATE"):
+            total_before = cls.select().count(db_batch)
+            for batch in chunked(pages, 500):
+                db_batch.execute(
+                    cls.insert_many(
+                        [dict(page=page, status=status) for page in batch]
+                    ).on_conflict_ignore()
+                )
+            return cls.select().count(db_batch) - total_before
+
+    @classmethod
+    def reset_in_progress(cls) -> int:
+        """
+        Возврат в очередь страниц, обработка которых прервалась (например, при перезапуске)
+        """
+
+        query = (
+            cls.update(status=cls.STATUS_PENDING)
+            .where(cls.status == cls.STATUS_IN_PROGRESS)
+        )
+        return query.execute(db_batch)
+
+    @classmethod
+    def start_new_pass(cls) -> int:
+        """
+        Новый проход по архиву: все страницы снова ставятся в очередь
+        """
+
+        query = cls.update(
+            status=cls.STATUS_PENDING,
+            attempts=0,
+            next_attempt_date_time=dt.datetime.now(),
+            last_error=None,
+        )
+        return query.execute(db_batch)
+
+    @classmethod
+    def claim(cls, limit: int) -> List[int]:
+        """
+        Взятие в работу страниц, для которых наступило время попытки.
+        Страницы берутся от последних к первым, как на bash.im/index
+        """
+
+        with db_batch.atomic("IMMEDIATE"):
+            query = (
+                cls.select(cls.page)
+                .where(
+                    cls.status == cls.STATUS_PENDING,
+                    cls.next_attempt_date_time <= dt.datetime.now(),
+                )
+                .order_by(cls.page.desc())
+                .limit(limit)
+                .bind(db_batch)
+            )
+            pages = [page for page, in query.tuples()]
+            if pages:
+                db_batch.execute(
+                    cls.update(
+                        status=cls.STATUS_IN_PROGRESS,
+                        modification_date_time=dt.datetime.now(),
+                    )
+                    .where(cls.page.in_(pages))
+                )
+
+            return pages
+
+    @classmethod
+    def set_done(cls, page: int, quotes: int, new_quotes: int):
+        query = (
+            cls.update(
+                status=cls.STATUS_DONE,
+                quotes=quotes,
+                new_quotes=new_quotes,
+                last_error=None,
+                modification_date_time=dt.datetime.now(),
+            )
+            .where(cls.page == page)
+        )
+        query.execute(db_batch)
+
+    @classmethod
+    def set_error(
+        cls,
+        page: int,
+        error: str,
+        retry_seconds: int,
+        max_attempts: int,
+    ) -> bool:
+        """
+        Учет ошибки страницы: она вернется в очередь через retry_seconds, удваивающиеся
+        с каждой попыткой, а после max_attempts попыток будет помечена как failed.
+        Вернет True, если будет повторная попытка
+        """
+
+        with db_batch.atomic("IMMEDIATE"):
+            crawl_page = cls.select().where(cls.page == page).bind(db_batch).get()
+            attempts = crawl_page.attempts + 1
+            will_retry = attempts < max_attempts
+
+            now = dt.datetime.now()
+            db_batch.execute(
+                cls.update(
+                    status=cls.STATUS_PENDING if will_retry else cls.STATUS_FAILED,
+                    attempts=attempts,
+                    next_attempt_date_time=now + dt.timedelta(
+                        seconds=retry_seconds * 2 ** (attempts - 1)
+                    ),
+                    last_error=error,
+                    modification_date_time=now,
+                )
+                .where(cls.page == page)
+            )
+            return will_retry
+
+    @classmethod
+    def get_number_by_status(cls) -> Dict[str, int]:
+        query = cls.select(cls.status, fn.COUNT(cls.page)).group_by(cls.status).tuples()
+        return dict(query)
+
+    @classmethod
+    def get_next_attempt_date_time(cls) -> Optional[dt.datetime]:
+        """
+        Время ближайшей попытки среди страниц в очереди, None - очередь пуста
+        """
+
+        crawl_page = (
+            cls.select(cls.next_attempt_date_time)
+            .where(cls.status == cls.STATUS_PENDING)
+            .order_by(cls.next_attempt_date_time)
+            .first()
+        )
+        return crawl_page.next_attempt_date_time if crawl_page else None
+
+    @classmethod
+    def get_last_modification_date_time(cls) -> Optional[dt.datetime]:
+        crawl_page = cls.select().order_by(cls.modification_date_time.desc()).first()
+        return crawl_page.modification_date_time if crawl_page else None
+
+
 class Error(BaseModel):
     class Meta:
         database = db_error
@@ -693,13 +2007,103 @@ class Error(BaseModel):
         return f"[{date_time_str}, {self.func_name}, {self.exception_class}] {self.error_text!r}"
 
 
+IS_FTS5_INSTALLED = QuoteTextIndex.fts5_installed()
+
 db.connect()
-db.create_tables([User, Chat, Quote, Comics, Request, Settings])
+db.create_tables(
+    [
+        User, Chat, Quote, Comics, Request, Settings,
+        QuoteCache, QuoteYearStats, Counter, UserStats, CrawlPage,
+    ]
+)
+for model in QuoteTextIndex.get_available_models():
+    model.create_index()
 
 db_error.connect()
 db_error.create_tables([Error])
 
 
+class RequestBuffer(WriteBehindBuffer):
+    """
+    Отложенная запись Request: строки записываются одним insert_many в транзакции
+    вместе с обновлением счетчиков
+    """
+
+    def add_request(self, is_new_quote: bool = False, **fields):
+        """
+        is_new_quote: цитата запроса получена пользователем впервые (для UserStats)
+        """
+
+        # Время запроса фиксируется сразу, а не при записи в базу
+        fields.setdefault("date_time", dt.datetime.now())
+        self.add((fields, is_new_quote))
+
+    def get_quote_ids(self, user_id: int) -> List[int]:
+        return [
+            row["quote"]
+            for row, _ in self.get_pending()
+            if row["user"] == user_id and row["quote"]
+        ]
+
+    def _write(self, items: List[Tuple[Dict, bool]]):
+        with db_batch.atomic("IMMEDIATE"):
+            for batch in chunked(items, 100):
+                db_batch.execute(Request.insert_many([row for row, _ in batch]))
+
+            Counter.increment(Counter.REQUESTS, len(items), database=db_batch)
+            UserStats.update_from_requests(items, database=db_batch)
+
+
+request_buffer = RequestBuffer(
+    max_size=REQUEST_BUFFER_MAX_SIZE,
+    flush_interval_ms=REQUEST_BUFFER_FLUSH_INTERVAL_MS,
+    max_attempts=REQUEST_BUFFER_MAX_ATTEMPTS,
+    max_pending=REQUEST_BUFFER_MAX_PENDING,
+    log=log,
+)
+atexit.register(request_buffer.flush_all)
+
+
+class LastActivityBuffer(WriteBehindBuffer):
+    """
+    Отложенная запись last_activity у User и Chat: одним UPDATE на каждую модель
+    """
+
+    def _write(self, items: List[Union[User, Chat]]):
+        model_by_last_activity: Dict[Type[BaseModel], Dict[int, str]] = dict()
+        for obj in items:
+            last_activity_by_id = model_by_last_activity.setdefault(obj.__class__, dict())
+            # Строка в формате DateTimeField, без стандартного адаптера datetime модуля sqlite3
+            last_activity_by_id[obj.id] = obj.last_activity.isoformat(sep=" ")
+
+        with db_batch.atomic("IMMEDIATE"):
+            for model_cls, last_activity_by_id in model_by_last_activity.items():
+                for batch in chunked(last_activity_by_id.items(), 100):
+                    query = (
+                        model_cls
+                        .update(last_activity=Case(model_cls.id, batch))
+                        .where(model_cls.id.in_([obj_id for obj_id, _ in batch]))
+                    )
+                    db_batch.execute(query)
+
+
+last_activity_buffer = LastActivityBuffer(
+    max_size=LAST_ACTIVITY_BUFFER_MAX_SIZE,
+    flush_interval_ms=LAST_ACTIVITY_FLUSH_INTERVAL_MS,
+    log=log,
+)
+atexit.register(last_activity_buffer.flush_all)
+
+
+# Пул всех цитат и просмотренные пользователями цитаты для Quote.get_user_unique_random
+quote_pool = QuotePool(loader=Quote.get_pool_items)
+seen_quotes = SeenQuotes(
+    loader=Request.get_seen_quote_ids,
+    max_users=SEEN_QUOTES_MAX_USERS,
+    ttl_seconds=SEEN_QUOTES_TTL_SECONDS,
+)
+
+
 if __name__ == "__main__":
     BaseModel.print_count_of_tables()
     print()
@@ -733,6 +2137,21 @@ if __name__ == "__main__":
     assert Quote.find("Arux") == Quote.find("ARUX")
     assert Quote.find("Arux") == Quote.find("Arux", case_insensitive=False)
 
+    assert get_full_text_query("Arux") == '"Arux"'
+    assert get_full_text_query('Arux "два слова" преф*') == '"Arux" "два слова" "преф"*'
+    assert get_full_text_query("Ar.x") is None
+    assert get_full_text_query("Ar*x") is None
+    assert not is_full_text_query("Arux")
+    assert is_full_text_query('"два слова"')
+    assert is_full_text_query("преф* Arux")
+    assert not is_full_text_query("Ar.x*")
+    if QuoteSearch.is_available():
+        assert Quote.search("Arux") == Quote.search("ARUX")
+
+    assert get_required_literals(r"(?i)hello\s+world") == ["hello", "world"]
+    assert get_required_literals(r"^abc(de|fgh)+xyz?") == ["abc"]
+    assert get_required_literals(r"a.b") == []
+
     print("Total users:", User.select().count())
     print("Total chats:", Chat.select().count())
 
@@ -764,6 +2183,24 @@ if __name__ == "__main__":
 
     print()
 
+    print("Quote.find performance stats (trigram index / full scan):")
+    for regex in ["Arux", r"\bкомпьютер", r"админ.+сервер", r"\d{4}", r"(?:windows|linux)"]:
+        t = time.perf_counter()
+        items_by_index = Quote.find(regex)
+        elapsed_by_index = time.perf_counter() - t
+
+        t = time.perf_counter()
+        items_by_scan = Quote.find(regex, use_index=False)
+        elapsed_by_scan = time.perf_counter() - t
+
+        assert items_by_index == items_by_scan
+        print(
+            f"    {regex!r:<20} found {len(items_by_index):<5} "
+            f"index {elapsed_by_index:.2f} secs, full scan {elapsed_by_scan:.2f} secs"
+        )
+
+    print()
+
     print("Quote.get_user_unique_random performance stats:")
     for limit in [100, 300, 500, 1000, 1500, 2000, 3000, 5000, 9999]:
         t = time.perf_counter()
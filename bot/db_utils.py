@@ -8,12 +8,12 @@ import datetime as dt
 import functools
 import html
 import logging
-import shutil
 import time
+from concurrent.futures import Future
 from pathlib import Path
 
 # pip install python-telegram-bot
-from typing import Union
+from typing import Callable, Union
 
 from telegram import Update, ReplyKeyboardMarkup
 from telegram.ext import CallbackContext
@@ -22,9 +22,21 @@ from telegram.ext import CallbackContext
 import schedule
 
 from bot import db
-from config import BACKUP_DIR_NAME, DB_DIR_NAME, DIR_COMICS, ERROR_TEXT
+from config import (
+    BACKUP_DIR_NAME,
+    BACKUP_KEEP,
+    BACKUP_MODE,
+    BACKUP_COMICS_MODE,
+    DB_DIR_NAME,
+    DB_FILE_NAME,
+    DIR_COMICS,
+    ERROR_TEXT,
+    STATS_RECONCILE_INTERVAL_MINUTES,
+)
 from common import reply_error, reply_info, get_date_time_str
-from bot.db import User, Chat, Quote, Request, Error
+from bot.db import User, Chat, Quote, Error
+from bot.backup import DatabaseBackup, ComicsBackup
+from bot.comics_downloader import comics_downloader
 from third_party import bash_im
 from third_party.notifications import send_telegram_notification_error
 
@@ -82,12 +94,19 @@ def process_request(log: logging.Logger):
                 quote_dbs.append(None)
 
             for quote_db in quote_dbs:
-                Request.create(
+                # Цитата отмечается просмотренной до постановки запроса в буфер,
+                # иначе при загрузке просмотренных она уже нашлась бы в буфере
+                is_new_quote = False
+                if user_db and quote_db:
+                    is_new_quote = db.seen_quotes.add(user_db.id, quote_db.id)
+
+                db.request_buffer.add_request(
+                    is_new_quote=is_new_quote,
                     func_name=func_name,
                     elapsed_ms=elapsed_ms,
-                    user=user_db,
-                    chat=chat_db,
-                    quote=quote_db,
+                    user=user_db.id if user_db else None,
+                    chat=chat_db.id if chat_db else None,
+                    quote=quote_db.id if quote_db else None,
                     message=message,
                     query_data=query_data,
                 )
@@ -131,6 +150,29 @@ def get_user_message_repr(user: User) -> str:
     """.rstrip()
 
 
+def run_with_attempts(
+        func: Callable,
+        log: logging.Logger,
+        attempts: int = 5,
+        delay_seconds: int = 30,
+) -> bool:
+    """
+    Вызов func до первого успешного, не больше attempts раз. Вернет True при успехе
+    """
+
+    for i in range(attempts):
+        try:
+            func()
+            return True
+
+        except Exception:
+            log.exception(f"Ошибка (попытка {i+1}):")
+            if i + 1 < attempts:
+                time.sleep(delay_seconds)
+
+    return False
+
+
 def db_create_backup(
         log: logging.Logger,
         backup_dir=BACKUP_DIR_NAME,
@@ -144,36 +186,43 @@ def db_create_backup(
     backup_path_comics = backup_path / DIR_COMICS.name
     backup_path_comics.mkdir(parents=True, exist_ok=True)
 
-    zip_name = dt.datetime.today().strftime(date_fmt)
-    zip_name = backup_path_db / zip_name
-
-    attempts = 5
-    for i in range(attempts):
-        try:
-            log.info(f"Создание бэкапа базы данных в: {zip_name}")
-            shutil.make_archive(zip_name, "zip", DB_DIR_NAME)
-
-            log.info(f"Создание бэкапа комиксов в: {backup_path_comics}")
-            for f in DIR_COMICS.glob("*"):
-                if not f.is_file():
-                    continue
-
-                backup_comics_file = backup_path_comics / f.name
-                if backup_comics_file.exists():
-                    continue
+    database_backup = DatabaseBackup(
+        DB_FILE_NAME,
+        backup_path_db,
+        mode=BACKUP_MODE,
+        log=log,
+    )
+    comics_backup = ComicsBackup(
+        DIR_COMICS,
+        backup_path_comics,
+        mode=BACKUP_COMICS_MODE,
+        log=log,
+    )
+    name = dt.datetime.today().strftime(date_fmt)
 
-                log.info(f"Сохранение {backup_comics_file.name}")
-                shutil.copyfile(f, backup_comics_file)
+    def _create_database_backup():
+        log.info(f"Создание бэкапа базы данных {name} в: {backup_path_db}")
+        database_backup.create(name)
 
-            # Всё хорошо завершилось, выходим из функции
-            return
+    def _create_comics_backup():
+        log.info(f"Создание бэкапа комиксов в: {backup_path_comics}")
+        comics_backup.create()
 
+    # Шаги повторяются по отдельности, чтобы ошибка бэкапа комиксов не пересоздавала снимок базы
+    is_ok_database = run_with_attempts(_create_database_backup, log)
+    if is_ok_database:
+        try:
+            database_backup.remove_old(keep=BACKUP_KEEP)
         except Exception:
-            log.exception(f"Ошибка (попытка {i+1}):")
-            time.sleep(30)
+            log.exception("Ошибка при удалении старых бэкапов базы данных:")
+
+    is_ok_comics = run_with_attempts(_create_comics_backup, log)
 
-    # Если дошли сюда, значит не получилось сохранить бэкап
-    send_telegram_notification_error(log.name, "Ошибка при создании бэкапа")
+    # Не получилось сохранить бэкап
+    if not is_ok_database:
+        send_telegram_notification_error(log.name, "Ошибка при создании бэкапа базы данных")
+    if not is_ok_comics:
+        send_telegram_notification_error(log.name, "Ошибка при создании бэкапа комиксов")
 
 
 def do_backup(log: logging.Logger):
@@ -186,6 +235,59 @@ def do_backup(log: logging.Logger):
         time.sleep(60)
 
 
+def do_reconcile_stats(log: logging.Logger):
+    def run():
+        try:
+            t = time.perf_counter_ns()
+            db.reconcile_stats()
+            elapsed_ms = (time.perf_counter_ns() - t) // 1_000_000
+            log.debug(f"[do_reconcile_stats] Elapsed {elapsed_ms} ms")
+
+        except Exception as e:
+            log.exception("[do_reconcile_stats] Error:")
+            Error.create_from(func=do_reconcile_stats, e=e)
+
+    # Сразу при запуске, чтобы заполнить таблицы статистики, и дальше периодически
+    run()
+
+    scheduler = schedule.Scheduler()
+    scheduler.every(STATS_RECONCILE_INTERVAL_MINUTES).minutes.do(run)
+
+    while True:
+        scheduler.run_pending()
+        time.sleep(60)
+
+
+def download_comics(
+    quote: bash_im.Quote,
+    dir_comics: Path = DIR_COMICS,
+    log: logging.Logger = None,
+):
+    """
+    Постановка комиксов цитаты в очередь фонового скачивания, файлы запишутся в Comics.
+    Результат не ожидается, по окончании скачивания он будет в логе.
+    Цитата уже должна быть в базе (Quote.get_from)
+    """
+
+    if not quote.comics_urls:
+        return
+
+    def _on_done(future: Future):
+        if future.exception():
+            return
+
+        log.info(f"Цитата #{quote.id}: скачано файлов комиксов {len(future.result())}")
+
+    future = comics_downloader.submit(quote, dir_comics)
+    if not log:
+        return
+
+    if future:
+        future.add_done_callback(_on_done)
+    else:
+        log.info(f"Цитата #{quote.id}: очередь скачивания заполнена, комиксы скачаются позже")
+
+
 def update_quote(
     quote_id: int,
     update: Update = None,
@@ -194,7 +296,7 @@ def update_quote(
 ):
     need_reply = update and context
 
-    quote_bashim = bash_im.Quote.parse_from(quote_id)
+    quote_bashim = bash_im.Quote.parse_from(quote_id, force_revalidate=True)
     if not quote_bashim:
         text = f"Цитаты #{quote_id} на сайте нет"
         log and log.info(text)
@@ -209,26 +311,28 @@ def update_quote(
         db.Quote.get_from(quote_bashim)
 
         # Сразу же пробуем скачать комиксы
-        quote_bashim.download_comics(DIR_COMICS)
+        download_comics(quote_bashim, log=log)
 
         text = f"Цитата #{quote_id} добавлена в базу"
         log and log.info(text)
         need_reply and reply_info(text, update, context)
 
     else:
+        # Изменения определяются и записываются так же, как при пакетном обновлении
         modified_list = []
-
-        if quote_db.text != quote_bashim.text:
-            quote_db.text = quote_bashim.text
+        if quote_db.text_sha256 != db.Quote.get_text_sha256(quote_bashim.text):
             modified_list.append("текст")
+        if quote_db.rating != quote_bashim.rating:
+            modified_list.append("рейтинг")
+
+        _, new_comics_ids = db.Quote.bulk_update_from([quote_bashim])
+        if new_comics_ids:
+            modified_list.append("комиксы")
 
         # Пробуем скачать комиксы
-        quote_bashim.download_comics(DIR_COMICS)
+        download_comics(quote_bashim, log=log)
 
         if modified_list:
-            quote_db.modification_date = dt.date.today()
-            quote_db.save()
-
             text = f'Цитата #{quote_id} обновлена ({", ".join(modified_list)})'
             log and log.info(text)
             need_reply and reply_info(text, update, context)
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+# SOURCE: http://docs.peewee-orm.com/en/latest/peewee/playhouse.html#schema-migrations
+
+
+from playhouse.migrate import SqliteDatabase, SqliteMigrator, migrate, IntegerField
+from config import DB_FILE_NAME
+
+
+db = SqliteDatabase(DB_FILE_NAME)
+migrator = SqliteMigrator(db)
+
+
+with db.atomic():
+    migrate(
+        migrator.add_column("quote", "year", IntegerField(null=True)),
+        migrator.add_column("quote", "text_length", IntegerField(null=True)),
+    )
+
+    # Заполнение новых полей для уже существующих цитат
+    db.execute_sql(
+        "UPDATE quote SET "
+        "year = CAST(strftime('%Y', date) AS INTEGER), "
+        "text_length = LENGTH(text)"
+    )
+
+    migrate(
+        migrator.add_index("quote", ("text_length",), False),
+        migrator.add_index("quote", ("year", "text_length"), False),
+    )
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+# Полнотекстовый индекс FTS5 для уже существующих цитат
+
+
+from playhouse.sqlite_ext import SqliteExtDatabase
+from config import DB_FILE_NAME
+
+
+db = SqliteExtDatabase(DB_FILE_NAME)
+
+
+with db.atomic():
+    db.execute_sql(
+        'CREATE VIRTUAL TABLE IF NOT EXISTS "quotesearch" USING fts5 ('
+        '"text", content="quote", content_rowid="id", '
+        'tokenize="unicode61 remove_diacritics 2"'
+        ')'
+    )
+    db.execute_sql("INSERT INTO quotesearch(quotesearch) VALUES('rebuild')")
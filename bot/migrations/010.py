@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+# Триграммный индекс FTS5 для уже существующих цитат. Требуется SQLite 3.34.0+
+
+
+from playhouse.sqlite_ext import SqliteExtDatabase
+from config import DB_FILE_NAME
+
+
+db = SqliteExtDatabase(DB_FILE_NAME)
+
+
+with db.atomic():
+    db.execute_sql(
+        'CREATE VIRTUAL TABLE IF NOT EXISTS "quotetrigram" USING fts5 ('
+        '"text", content="quote", content_rowid="id", tokenize="trigram"'
+        ')'
+    )
+    db.execute_sql("INSERT INTO quotetrigram(quotetrigram) VALUES('rebuild')")
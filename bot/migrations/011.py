@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+# SOURCE: http://docs.peewee-orm.com/en/latest/peewee/playhouse.html#schema-migrations
+
+
+from playhouse.migrate import SqliteDatabase, SqliteMigrator, migrate, IntegerField
+from config import DB_FILE_NAME
+
+
+db = SqliteDatabase(DB_FILE_NAME)
+migrator = SqliteMigrator(db)
+
+
+with db.atomic():
+    migrate(
+        migrator.add_column("quote", "comics_count", IntegerField(default=0)),
+    )
+
+    # Заполнение нового поля для уже существующих цитат
+    db.execute_sql(
+        "UPDATE quote SET comics_count = "
+        "(SELECT COUNT(*) FROM comics WHERE comics.quote_id = quote.id)"
+    )
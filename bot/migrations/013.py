@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+# SOURCE: http://docs.peewee-orm.com/en/latest/peewee/playhouse.html#schema-migrations
+
+
+import hashlib
+
+from playhouse.migrate import (
+    SqliteDatabase, SqliteMigrator, migrate, TextField, IntegerField
+)
+from config import DB_FILE_NAME, DIR_COMICS
+
+
+db = SqliteDatabase(DB_FILE_NAME)
+migrator = SqliteMigrator(db)
+
+
+with db.atomic():
+    migrate(
+        migrator.add_column("comics", "file_name", TextField(null=True)),
+        migrator.add_column("comics", "file_size", IntegerField(null=True)),
+        migrator.add_column("comics", "file_sha256", TextField(null=True)),
+    )
+
+    # Заполнение индекса файлов по уже скачанным комиксам: quote<id цитаты>_<id комикса>.png
+    comics_by_key = dict()
+    for comics_id, quote_id, url in db.execute_sql("SELECT id, quote_id, url FROM comics"):
+        comics_by_key[(quote_id, url.rstrip("/").split("/")[-1])] = comics_id
+
+    for file_path in DIR_COMICS.glob("quote*_*.png"):
+        quote_id, comics_key = file_path.stem[len("quote"):].split("_", maxsplit=1)
+        comics_id = comics_by_key.get((int(quote_id), comics_key))
+        if not comics_id:
+            continue
+
+        data = file_path.read_bytes()
+        db.execute_sql(
+            "UPDATE comics SET file_name = ?, file_size = ?, file_sha256 = ? WHERE id = ?",
+            (file_path.name, len(data), hashlib.sha256(data).hexdigest(), comics_id),
+        )
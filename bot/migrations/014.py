@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+# SOURCE: http://docs.peewee-orm.com/en/latest/peewee/playhouse.html#schema-migrations
+
+
+import hashlib
+
+from playhouse.migrate import SqliteDatabase, SqliteMigrator, migrate, TextField
+from config import DB_FILE_NAME
+
+
+db = SqliteDatabase(DB_FILE_NAME)
+migrator = SqliteMigrator(db)
+
+
+@db.func("sha256_hex", num_params=1)
+def sha256_hex(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+with db.atomic():
+    migrate(
+        migrator.add_column("quote", "text_sha256", TextField(null=True)),
+    )
+
+    # Заполнение нового поля для уже существующих цитат
+    db.execute_sql("UPDATE quote SET text_sha256 = sha256_hex(text)")
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+# SOURCE: http://docs.peewee-orm.com/en/latest/peewee/playhouse.html#schema-migrations
+
+
+from playhouse.migrate import SqliteDatabase, SqliteMigrator, migrate, DateField
+from config import DB_FILE_NAME
+
+
+db = SqliteDatabase(DB_FILE_NAME)
+migrator = SqliteMigrator(db)
+
+
+# Дата последней проверки цитаты на сайте. Для уже существующих цитат остается пустой,
+# вместо нее используется modification_date
+with db.atomic():
+    migrate(
+        migrator.add_column("quote", "refresh_date", DateField(null=True)),
+    )
@@ -4,18 +4,32 @@
 __author__ = "ipetrash"
 
 
+import datetime as dt
 import inspect
 import logging
 import time
 
 from random import randint
 from threading import RLock
+from typing import Iterable, List
 
 # pip install schedule
 import schedule
 
+# pip install peewee
+from peewee import chunked
+
 from bot import db
-from config import DIR
+from bot.comics_downloader import comics_downloader
+from bot.crawler import ArchiveCrawler
+from config import (
+    DIR,
+    CRAWLER_WORKERS,
+    CRAWLER_MAX_ATTEMPTS,
+    CRAWLER_RETRY_SECONDS,
+    CRAWLER_PASS_INTERVAL_DAYS,
+    SAVE_QUOTES_BATCH_SIZE,
+)
 from third_party import bash_im
 from third_party.notifications import send_telegram_notification_error
 
@@ -23,10 +37,6 @@ from third_party.notifications import send_telegram_notification_error
 NEXT_CHECKED_PAGE = DIR / "_NEXT_CHECKED_PAGE.txt"
 
 
-def save_next_checked_page(page: int):
-    NEXT_CHECKED_PAGE.write_text(str(page))
-
-
 def read_next_checked_page() -> int:
     try:
         return int(NEXT_CHECKED_PAGE.read_text())
@@ -43,6 +53,29 @@ def caller_name() -> str:
 lock = RLock()
 
 
+def save_quotes(
+    quotes: Iterable[bash_im.Quote],
+    dir_comics,
+    batch_size: int = SAVE_QUOTES_BATCH_SIZE,
+) -> List[int]:
+    """
+    Добавление цитат в базу пачками по batch_size и постановка их комиксов в очередь скачивания.
+    Для генератора цитат запись и скачивание комиксов начинаются до окончания разбора страницы.
+    Вернет id новых цитат
+    """
+
+    new_ids = []
+    for batch in chunked(quotes, batch_size):
+        new_ids += db.Quote.bulk_get_from(batch)
+
+        # Комиксы скачаются в фоне
+        for quote in batch:
+            if quote.comics_urls:
+                comics_downloader.submit(quote, dir_comics)
+
+    return new_ids
+
+
 def download_random_quotes(log: logging.Logger, dir_comics):
     prefix = f"[{caller_name()}]"
     i = 0
@@ -50,21 +83,15 @@ def download_random_quotes(log: logging.Logger, dir_comics):
     while True:
         try:
             with lock:
-                count = db.Quote.select().count()
-                log.debug(f"{prefix} Quotes: {count}")
                 t = time.perf_counter_ns()
 
-                for quote in bash_im.get_random_quotes(log):
-                    # При отсутствии, цитата будет добавлена в базу
-                    db.Quote.get_from(quote)
-
-                    # Сразу же пробуем скачать комиксы
-                    quote.download_comics(dir_comics)
+                quotes = bash_im.iter_random_quotes(log)
+                new_ids = save_quotes(quotes, dir_comics)
 
                 elapsed_ms = (time.perf_counter_ns() - t) // 1_000_000
                 log.debug(
                     f"{prefix} Added new quotes (random): %s, elapsed %s ms",
-                    db.Quote.select().count() - count,
+                    len(new_ids),
                     elapsed_ms,
                 )
 
@@ -96,21 +123,15 @@ def download_main_page_quotes(log: logging.Logger, dir_comics):
         while True:
             try:
                 with lock:
-                    count = db.Quote.select().count()
-                    log.debug(f"{prefix} Quotes: {count}")
                     t = time.perf_counter_ns()
 
-                    for quote in bash_im.get_main_page_quotes(log):
-                        # При отсутствии, цитата будет добавлена в базу
-                        db.Quote.get_from(quote)
-
-                        # Сразу же пробуем скачать комиксы
-                        quote.download_comics(dir_comics)
+                    quotes = bash_im.iter_page_quotes(logger=log)
+                    new_ids = save_quotes(quotes, dir_comics)
 
                     elapsed_ms = (time.perf_counter_ns() - t) // 1_000_000
                     log.debug(
                         f"{prefix} Added new quotes (main page): %s, elapsed %s ms",
-                        db.Quote.select().count() - count,
+                        len(new_ids),
                         elapsed_ms,
                     )
 
@@ -132,40 +153,53 @@ def download_main_page_quotes(log: logging.Logger, dir_comics):
 
 
 def download_seq_page_quotes(log: logging.Logger, dir_comics):
+    """
+    Обход всего архива bash.im через ArchiveCrawler. Проходы повторяются
+    раз в CRAWLER_PASS_INTERVAL_DAYS, прерванный проход продолжается после перезапуска
+    """
+
     prefix = f"[{caller_name()}]"
 
-    i = 0
+    crawler = ArchiveCrawler(
+        save_quotes=save_quotes,
+        workers=CRAWLER_WORKERS,
+        max_attempts=CRAWLER_MAX_ATTEMPTS,
+        retry_seconds=CRAWLER_RETRY_SECONDS,
+        log=log,
+    )
+
     while True:
         try:
-            page = read_next_checked_page()
-
-            # Если дошли до последней страницы, начинаем заново
-            if page < 1:
-                log.debug(f"{prefix} Starting over again")
-                page = bash_im.get_total_pages()
-
-            with lock:
-                count = db.Quote.select().count()
-                log.debug(f"{prefix} Quotes: {count}")
-                t = time.perf_counter_ns()
-
-                for quote in bash_im.get_page_quotes(page, log):
-                    # При отсутствии, цитата будет добавлена в базу
-                    db.Quote.get_from(quote)
-
-                    # Сразу же попробуем скачать комиксы
-                    quote.download_comics(dir_comics)
-
-                elapsed_ms = (time.perf_counter_ns() - t) // 1_000_000
-                log.debug(
-                    f"{prefix} Added new quotes (page %s): %s, elapsed %s ms",
-                    page,
-                    db.Quote.select().count() - count,
-                    elapsed_ms,
-                )
-
-            page -= 1
-            save_next_checked_page(page)
+            # Прежний обход сохранял только следующую страницу, страницы после нее уже проверены
+            checked_pages_from = None
+            if not db.CrawlPage.select().exists() and NEXT_CHECKED_PAGE.exists():
+                checked_pages_from = read_next_checked_page()
+
+            number = crawler.add_pages(bash_im.get_total_pages(), checked_pages_from)
+            log.debug(f"{prefix} Added pages to crawl: %s", number)
+
+            t = time.perf_counter_ns()
+            crawler.run(dir_comics)
+
+            elapsed_ms = (time.perf_counter_ns() - t) // 1_000_000
+            log.debug(
+                f"{prefix} Pass finished: pages %s (failed %s), new quotes %s, elapsed %s ms",
+                crawler.pages_done,
+                crawler.pages_failed,
+                crawler.new_quotes,
+                elapsed_ms,
+            )
+
+            # Следующий проход через CRAWLER_PASS_INTERVAL_DAYS после окончания предыдущего
+            next_pass_date_time = db.CrawlPage.get_last_modification_date_time() + dt.timedelta(
+                days=CRAWLER_PASS_INTERVAL_DAYS
+            )
+            timeout = (next_pass_date_time - dt.datetime.now()).total_seconds()
+            if timeout > 0:
+                log.debug(f"{prefix} Next pass at %s", next_pass_date_time)
+                time.sleep(timeout)
+
+            db.CrawlPage.start_new_pass()
 
         except Exception:
             log.exception(f"{prefix} Error:")
@@ -173,23 +207,6 @@ def download_seq_page_quotes(log: logging.Logger, dir_comics):
             log.info(f"{prefix} I'll try again in 1 minute ...")
             time.sleep(60)
 
-        finally:
-            # 3 - 15 minutes
-            minutes = randint(3, 15)
-            log.debug(f"{prefix} Mini sleep: %s minutes", minutes)
-
-            time.sleep(minutes * 60)
-
-            i += 1
-            if i >= 10:
-                i = 0
-
-                # 3 - 6 hours
-                minutes = randint(3 * 60, 6 * 60)
-                log.debug(f"{prefix} Deep sleep: %s minutes", minutes)
-
-                time.sleep(minutes * 60)
-
 
 def run_parser_health_check(log: logging.Logger):
     prefix = f"[{caller_name()}]"
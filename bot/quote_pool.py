@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import bisect
+import random
+import time
+from array import array
+from collections import OrderedDict
+from threading import RLock
+from typing import Iterable, Iterator, List, Dict, Optional, Callable, Tuple, Container
+
+
+class QuoteIdSet:
+    """
+    Компактное множество id цитат: отсортированный массив 4-байтовых чисел
+    """
+
+    def __init__(self, items: Iterable[int] = ()):
+        self._items = array("I", sorted(set(items)))
+
+    def add(self, quote_id: int) -> bool:
+        """
+        Добавление id цитаты. Вернет True, если id раньше не было
+        """
+
+        i = bisect.bisect_left(self._items, quote_id)
+        if i < len(self._items) and self._items[i] == quote_id:
+            return False
+
+        self._items.insert(i, quote_id)
+        return True
+
+    def __contains__(self, quote_id: int) -> bool:
+        i = bisect.bisect_left(self._items, quote_id)
+        return i < len(self._items) and self._items[i] == quote_id
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._items)
+
+
+class SeenQuotes:
+    """
+    Просмотренные пользователями цитаты. Для каждого пользователя множество
+    загружается из базы при первом обращении и дальше дополняется в process_request.
+    Хранятся множества не больше max_users пользователей: при переполнении вытесняются
+    давно не использовавшиеся, а не использовавшиеся дольше ttl_seconds удаляются.
+    При следующем обращении множество загрузится снова
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[int], Iterable[int]],
+        max_users: int,
+        ttl_seconds: int,
+    ):
+        self._loader = loader
+        self.max_users = max_users
+        self.ttl_seconds = ttl_seconds
+
+        self._lock = RLock()
+        self._by_user: Dict[int, Tuple[float, QuoteIdSet]] = OrderedDict()
+
+    def get(self, user_id: int) -> QuoteIdSet:
+        with self._lock:
+            now = time.monotonic()
+
+            item = self._by_user.get(user_id)
+            if item is None or now - item[0] > self.ttl_seconds:
+                items = QuoteIdSet(self._loader(user_id))
+            else:
+                items = item[1]
+
+            self._by_user[user_id] = now, items
+            self._by_user.move_to_end(user_id)
+
+            # В начале - давно не использовавшиеся
+            while self._by_user:
+                last_access, _ = next(iter(self._by_user.values()))
+                if len(self._by_user) <= self.max_users and now - last_access <= self.ttl_seconds:
+                    break
+                self._by_user.popitem(last=False)
+
+            return items
+
+    def add(self, user_id: int, quote_id: int) -> bool:
+        with self._lock:
+            return self.get(user_id).add(quote_id)
+
+
+class YearBucket:
+    """
+    Цитаты одного года, отсортированные по размеру текста: отбор по максимальному размеру
+    сводится к поиску границы в отсортированном массиве
+    """
+
+    def __init__(self):
+        self.text_lengths = array("I")
+        self.ids = array("I")
+
+    def add(self, quote_id: int, text_length: int):
+        i = bisect.bisect_right(self.text_lengths, text_length)
+        self.text_lengths.insert(i, text_length)
+        self.ids.insert(i, quote_id)
+
+    def remove(self, quote_id: int, text_length: int):
+        lo = bisect.bisect_left(self.text_lengths, text_length)
+        hi = bisect.bisect_right(self.text_lengths, text_length)
+        for i in range(lo, hi):
+            if self.ids[i] == quote_id:
+                del self.text_lengths[i]
+                del self.ids[i]
+                return
+
+    def get_size(self, max_text_length: int = None) -> int:
+        """
+        Количество цитат с размером текста не больше max_text_length
+        """
+
+        if not max_text_length:
+            return len(self.ids)
+
+        return bisect.bisect_right(self.text_lengths, max_text_length)
+
+
+class QuotePool:
+    """
+    Все id цитат в памяти, сгруппированные по годам, вместе с размерами их текстов.
+    Позволяет выбирать случайные непросмотренные цитаты без ORDER BY RANDOM() по всей таблице
+    """
+
+    def __init__(self, loader: Callable[[], Iterable[Tuple[int, int, int]]]):
+        self._loader = loader
+        self._lock = RLock()
+        self._by_year: Optional[Dict[int, YearBucket]] = None
+        self._text_lengths: Dict[int, int] = dict()
+
+    def _load(self):
+        if self._by_year is not None:
+            return
+
+        self._by_year = dict()
+        for quote_id, year, text_length in self._loader():
+            self._add(quote_id, year, text_length)
+
+    def _add(self, quote_id: int, year: int, text_length: int):
+        text_length = text_length or 0
+
+        if year not in self._by_year:
+            self._by_year[year] = YearBucket()
+        bucket = self._by_year[year]
+
+        old_text_length = self._text_lengths.get(quote_id)
+        if old_text_length == text_length:
+            return
+
+        # Размер текста изменился, цитата переставляется на новое место
+        if old_text_length is not None:
+            bucket.remove(quote_id, old_text_length)
+
+        bucket.add(quote_id, text_length)
+        self._text_lengths[quote_id] = text_length
+
+    def add(self, quote_id: int, year: int, text_length: int):
+        with self._lock:
+            # Пока пул не загружен, цитата и так попадет в него из базы
+            if self._by_year is None:
+                return
+
+            self._add(quote_id, year, text_length)
+
+    def get_random_unseen(
+        self,
+        seen: Container[int],
+        limit: int,
+        years: List[int] = None,
+        max_text_length: int = None,
+        exclude: Container[int] = (),
+    ) -> List[int]:
+        result = []
+        found = set()
+
+        def is_suitable(quote_id: int) -> bool:
+            return quote_id not in found and quote_id not in seen and quote_id not in exclude
+
+        with self._lock:
+            self._load()
+
+            # Подходящие по фильтрам цитаты каждого года - начало его массива
+            candidates = [
+                (bucket.ids, bucket.get_size(max_text_length))
+                for year, bucket in self._by_year.items()
+                if not years or year in years
+            ]
+            candidates = [(ids, size) for ids, size in candidates if size]
+            total = sum(size for _, size in candidates)
+
+            # Случайные попадания в подходящие цитаты с отбрасыванием просмотренных.
+            # Пока непросмотренных цитат много, требуется порядка limit попыток
+            attempts = limit * 10
+            while total and len(result) < limit and attempts > 0:
+                attempts -= 1
+
+                i = random.randrange(total)
+                for ids, size in candidates:
+                    if i < size:
+                        quote_id = ids[i]
+                        break
+                    i -= size
+
+                if is_suitable(quote_id):
+                    result.append(quote_id)
+                    found.add(quote_id)
+
+            # Копии подходящих частей массивов, чтобы перебирать их без блокировки пула
+            if len(result) < limit:
+                candidates = [ids[:size] for ids, size in candidates]
+
+        # Непросмотренных цитат осталось мало, выбираем из полного списка подходящих
+        if len(result) < limit:
+            items = [
+                quote_id
+                for ids in candidates
+                for quote_id in ids
+                if is_suitable(quote_id)
+            ]
+            result += random.sample(items, min(limit - len(result), len(items)))
+
+        return result
+
+
+if __name__ == "__main__":
+    items = QuoteIdSet([5, 1, 3, 3])
+    assert list(items) == [1, 3, 5]
+    assert items.add(4)
+    assert not items.add(4)
+    assert 4 in items and 2 not in items
+    assert len(items) == 4
+
+    pool = QuotePool(
+        loader=lambda: [(i, 2004 + i % 3, i * 10) for i in range(1, 101)]
+    )
+    seen = QuoteIdSet(range(1, 91))
+
+    ids = pool.get_random_unseen(seen, limit=20)
+    assert sorted(ids) == list(range(91, 101))
+
+    ids = pool.get_random_unseen(seen, limit=5, years=[2004])
+    assert all(i % 3 == 0 and i > 90 for i in ids)
+
+    ids = pool.get_random_unseen(QuoteIdSet(), limit=50, max_text_length=200)
+    assert sorted(ids) == list(range(1, 21))
+
+    ids = pool.get_random_unseen(seen, limit=20, exclude={91, 92})
+    assert sorted(ids) == list(range(93, 101))
+
+    # Цитата с измененным размером текста перестает подходить под фильтр
+    pool.add(5, 2004 + 5 % 3, 1000)
+    ids = pool.get_random_unseen(QuoteIdSet(), limit=50, max_text_length=200)
+    assert sorted(ids) == [i for i in range(1, 21) if i != 5]
+
+    # Вытесненное множество загружается снова
+    loaded = []
+    seen_quotes = SeenQuotes(
+        loader=lambda user_id: loaded.append(user_id) or [user_id],
+        max_users=2,
+        ttl_seconds=60,
+    )
+    assert seen_quotes.add(1, 10) and not seen_quotes.add(1, 10)
+    seen_quotes.get(2)
+    seen_quotes.get(3)
+    assert 10 not in seen_quotes.get(1)
+    assert loaded == [1, 2, 3, 1]
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import datetime as dt
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Tuple
+
+from bot import db
+from bot.comics_downloader import comics_downloader
+from config import DIR_COMICS
+from third_party import bash_im
+
+
+@dataclass
+class RefreshStats:
+    total: int = 0
+    checked: int = 0
+    changed: int = 0
+    new_comics: int = 0
+    not_found: int = 0
+    errors: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def quotes_per_second(self) -> float:
+        return self.checked / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        percent = self.checked * 100 / self.total if self.total else 100.0
+
+        eta = ""
+        if self.quotes_per_second:
+            eta_seconds = (self.total - self.checked) / self.quotes_per_second
+            eta = f", ETA {dt.timedelta(seconds=int(eta_seconds))}"
+
+        return (
+            f"checked {self.checked}/{self.total} ({percent:.1f}%), "
+            f"changed {self.changed}, new comics {self.new_comics}, "
+            f"not found {self.not_found}, errors {self.errors}, "
+            f"{self.quotes_per_second:.2f} quotes/s{eta}"
+        )
+
+
+class QuoteRefresher:
+    """
+    Пакетное обновление цитат, не проверявшихся на сайте с указанной даты. Цитаты скачиваются
+    несколькими потоками с общим ограничением частоты запросов (bash_im.rate_limiter),
+    а изменения записываются через Quote.bulk_update_from пачками по batch_size
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        batch_size: int,
+        log: logging.Logger = None,
+    ):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.log = log
+
+    def _fetch(self, quote_id: int) -> Tuple[int, Optional[bash_im.Quote], Optional[Exception]]:
+        try:
+            return quote_id, bash_im.Quote.parse_from(quote_id, force_revalidate=True), None
+        except Exception as e:
+            return quote_id, None, e
+
+    def run(
+        self,
+        refresh_date: dt.date,
+        dir_comics: Path = DIR_COMICS,
+    ) -> RefreshStats:
+        """
+        Обновление цитат, не проверявшихся на сайте с refresh_date включительно.
+        Цитаты с ошибками скачивания не обновляются и будут взяты при следующем запуске
+        """
+
+        prefix = f"[{self.__class__.__name__}]"
+
+        stats = RefreshStats(
+            total=db.Quote.get_stale(refresh_date).count()
+        )
+        if self.log:
+            self.log.info(f"{prefix} Stale quotes: {stats.total}")
+
+        t = time.perf_counter()
+        last_id = 0
+
+        with ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix=self.__class__.__name__
+        ) as executor:
+            while True:
+                quote_ids = db.Quote.get_stale_ids(
+                    refresh_date, after_id=last_id, limit=self.batch_size
+                )
+                if not quote_ids:
+                    break
+
+                last_id = quote_ids[-1]
+
+                quotes = []
+                for quote_id, quote, error in executor.map(self._fetch, quote_ids):
+                    if error:
+                        stats.errors += 1
+                        if self.log:
+                            self.log.warning(f"{prefix} Error on quote #{quote_id}: {error}")
+
+                    elif not quote:
+                        stats.not_found += 1
+
+                    else:
+                        quotes.append(quote)
+
+                changed_ids, new_comics_ids = db.Quote.bulk_update_from(quotes)
+
+                # Комиксы скачаются в фоне, уже скачанные файлы пропускаются
+                for quote in quotes:
+                    if quote.comics_urls:
+                        comics_downloader.submit(quote, dir_comics)
+
+                stats.checked += len(quote_ids)
+                stats.changed += len(changed_ids)
+                stats.new_comics += len(new_comics_ids)
+                stats.elapsed = time.perf_counter() - t
+
+                if self.log:
+                    self.log.info(f"{prefix} {stats}")
+
+        return stats
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+import abc
+import logging
+import time
+from threading import Condition, Lock, Thread
+from typing import Any, List
+
+
+class WriteBehindBuffer(abc.ABC):
+    """
+    Буфер отложенной записи: элементы копятся в памяти и записываются пачкой
+    в фоновом потоке, когда их набирается max_size или раз в flush_interval_ms миллисекунд.
+    Пачка, которую не удалось записать за max_attempts попыток, отбрасывается,
+    а при переполнении буфера (max_pending) отбрасываются самые старые элементы
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        flush_interval_ms: int,
+        max_attempts: int = 5,
+        max_pending: int = None,
+        log: logging.Logger = None,
+    ):
+        self.max_size = max_size
+        self.flush_interval_ms = flush_interval_ms
+        self.max_attempts = max_attempts
+        self.max_pending = max_pending or max_size * 100
+        self.log = log
+
+        self._condition = Condition()
+        self._flush_lock = Lock()
+        self._items: List[Any] = []
+
+        # Пачка после неудачной записи и число сделанных попыток
+        self._retry_items: List[Any] = []
+        self._retry_attempts = 0
+
+        # Записываемые в данный момент элементы, до окончания записи они еще не в базе
+        self._in_flight: List[Any] = []
+
+        self._thread: Thread = None
+
+        self.total_flushed = 0
+        self.total_dropped = 0
+        self.last_flush_elapsed_ms = 0
+        self.max_flush_elapsed_ms = 0
+
+    @property
+    def depth(self) -> int:
+        with self._condition:
+            return len(self._items) + len(self._retry_items) + len(self._in_flight)
+
+    def get_pending(self) -> List[Any]:
+        with self._condition:
+            return self._in_flight + self._retry_items + self._items
+
+    def add(self, item: Any):
+        with self._condition:
+            if len(self._items) + len(self._retry_items) >= self.max_pending:
+                self._items.pop(0)
+                self.total_dropped += 1
+                if self.log and self.total_dropped % self.max_size == 1:
+                    self.log.warning(
+                        f"[{self.__class__.__name__}] Buffer is full ({self.max_pending}), "
+                        f"the oldest items are dropped. Total dropped: {self.total_dropped}"
+                    )
+
+            self._items.append(item)
+
+            if not self._thread:
+                self._thread = Thread(target=self._run, name=self.__class__.__name__, daemon=True)
+                self._thread.start()
+
+            if len(self._items) >= self.max_size:
+                self._condition.notify()
+
+    def _run(self):
+        is_failed = False
+        while True:
+            with self._condition:
+                # После ошибки следующая попытка не раньше чем через flush_interval_ms
+                if is_failed or len(self._items) < self.max_size:
+                    self._condition.wait(timeout=self.flush_interval_ms / 1000)
+
+            try:
+                self.flush()
+                is_failed = False
+            except Exception:
+                is_failed = True
+                if self.log:
+                    self.log.exception(f"[{self.__class__.__name__}] Error:")
+
+    def flush(self):
+        with self._flush_lock:
+            with self._condition:
+                # Сначала повторяется пачка, которую не удалось записать
+                if self._retry_items:
+                    self._in_flight, self._retry_items = self._retry_items, []
+                    attempts = self._retry_attempts
+                elif self._items:
+                    self._in_flight, self._items = self._items, []
+                    attempts = 0
+                else:
+                    return
+
+            t = time.perf_counter_ns()
+            try:
+                self._write(self._in_flight)
+            except Exception:
+                attempts += 1
+                with self._condition:
+                    if attempts < self.max_attempts:
+                        self._retry_items = self._in_flight
+                        self._retry_attempts = attempts
+                    else:
+                        self.total_dropped += len(self._in_flight)
+                        if self.log:
+                            self.log.error(
+                                f"[{self.__class__.__name__}] Dropped {len(self._in_flight)} items "
+                                f"after {attempts} failed attempts"
+                            )
+                raise
+            finally:
+                with self._condition:
+                    flushed = len(self._in_flight)
+                    self._in_flight = []
+
+            elapsed_ms = (time.perf_counter_ns() - t) // 1_000_000
+            self.total_flushed += flushed
+            self.last_flush_elapsed_ms = elapsed_ms
+            self.max_flush_elapsed_ms = max(self.max_flush_elapsed_ms, elapsed_ms)
+
+            if self.log:
+                self.log.debug(
+                    f"[{self.__class__.__name__}] Flushed {flushed} items, elapsed {elapsed_ms} ms"
+                )
+
+    def flush_all(self):
+        """
+        Запись всех элементов буфера, в том числе отложенных после ошибки, например
+        при завершении работы. Остановится после max_attempts неудачных записей
+        """
+
+        failures = 0
+        while True:
+            with self._condition:
+                if not self._items and not self._retry_items:
+                    return
+
+            try:
+                self.flush()
+            except Exception:
+                failures += 1
+                if self.log:
+                    self.log.exception(f"[{self.__class__.__name__}] Error:")
+
+                if failures >= self.max_attempts:
+                    return
+
+    @abc.abstractmethod
+    def _write(self, items: List[Any]):
+        pass
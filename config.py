@@ -33,14 +33,45 @@ ADMIN_USERNAME = "@ilya_petrash"
 DIR_COMICS = DIR / "comics"
 DIR_COMICS.mkdir(parents=True, exist_ok=True)
 
+# Кэш ответов bash.im: время жизни по видам страниц в секундах,
+# 0 - всегда проверять на сервере (ETag/Last-Modified), None - не кэшировать
+DIR_HTTP_CACHE = DIR / "http_cache"
+HTTP_CACHE_TTL = {
+    "main": 0,
+    "index": 7 * 24 * 60 * 60,
+    "quote": 24 * 60 * 60,
+    "strip": 30 * 24 * 60 * 60,
+    "image": None,
+    "random": None,
+}
+# Ограничения кэша: размер в байтах и возраст ответа в секундах, None - без ограничения
+HTTP_CACHE_MAX_SIZE = 512 * 1024 * 1024
+HTTP_CACHE_MAX_AGE = 90 * 24 * 60 * 60
+
 DB_DIR_NAME = DIR / "database"
 DB_DIR_NAME.mkdir(parents=True, exist_ok=True)
 
 DB_FILE_NAME = str(DB_DIR_NAME / "database.sqlite")
 
-BACKUP_ROOT = Path("D:/")
+# Корень бэкапов задается переменной окружения BACKUP_ROOT
+BACKUP_ROOT = Path(
+    os.environ.get("BACKUP_ROOT") or ("D:/" if os.name == "nt" else DIR.parent)
+)
 BACKUP_DIR_NAME = BACKUP_ROOT / "backup" / DIR.name
 
+# Бэкап базы: full - сжатый снимок целиком,
+# incremental - снимок частями по BACKUP_CHUNK_SIZE байт, записываются только новые части
+BACKUP_MODE = os.environ.get("BACKUP_MODE") or "incremental"
+BACKUP_CHUNK_SIZE = 1024 * 1024
+
+# Сколько последних бэкапов базы хранить, старые удаляются вместе с неиспользуемыми частями
+BACKUP_KEEP = 8
+
+# Бэкап комиксов: copy, hardlink или reflink (для двух последних папки должны быть на одной
+# файловой системе, иначе будет копирование) и количество потоков
+BACKUP_COMICS_MODE = os.environ.get("BACKUP_COMICS_MODE") or "copy"
+BACKUP_COMICS_WORKERS = 4
+
 DB_DIR_NAME_ERROR = DIR / "database_error"
 DB_DIR_NAME_ERROR.mkdir(parents=True, exist_ok=True)
 
@@ -65,6 +96,57 @@ RADIOBUTTON = "🟢"
 RADIOBUTTON_EMPTY = "⚪️"
 
 QUOTES_LIMIT = 20
+
+# Когда в кэше пользователя остается меньше цитат, кэш пополняется в фоне
+QUOTES_LOW_WATERMARK = 5
+QUOTES_PREFETCH_WORKERS = 2
+
+# Отложенная запись Request: каждые N строк или M миллисекунд
+REQUEST_BUFFER_MAX_SIZE = 50
+REQUEST_BUFFER_FLUSH_INTERVAL_MS = 1000
+# Пачка, не записанная за N попыток, отбрасывается; при переполнении буфера отбрасываются старые строки
+REQUEST_BUFFER_MAX_ATTEMPTS = 5
+REQUEST_BUFFER_MAX_PENDING = 10_000
+
+# Отложенная запись времени последней активности пользователей и чатов: каждые N объектов или M миллисекунд
+LAST_ACTIVITY_BUFFER_MAX_SIZE = 1000
+LAST_ACTIVITY_FLUSH_INTERVAL_MS = 30_000
+
+# Кэш загруженных пользователей и чатов: максимальный размер и время жизни объекта
+IDENTITY_CACHE_MAX_SIZE = 10_000
+IDENTITY_CACHE_TTL_SECONDS = 60 * 60
+
+# Просмотренные цитаты в памяти: не больше N пользователей, неактивные дольше M секунд вытесняются
+SEEN_QUOTES_MAX_USERS = 1000
+SEEN_QUOTES_TTL_SECONDS = 60 * 60
+
+# Пересчет таблиц статистики по исходным таблицам
+STATS_RECONCILE_INTERVAL_MINUTES = 60
+
+# Интервал между запросами к одному хосту bash.im, общий для обхода архива, обновления цитат
+# и скачивания комиксов. Ответы из кэша (HTTP_CACHE_TTL) его не ждут
+BASH_IM_HOST_INTERVAL_MS = 500
+
+# Фоновое скачивание комиксов: потоки и размер очереди
+COMICS_DOWNLOAD_WORKERS = 4
+COMICS_DOWNLOAD_MAX_PENDING = 1000
+
+# Цитаты страницы записываются в базу пачками по мере разбора,
+# комиксы пачки ставятся в очередь скачивания сразу после ее записи
+SAVE_QUOTES_BATCH_SIZE = 10
+
+# Обход архива bash.im: потоки, повторы страниц с ошибками (пауза удваивается
+# с каждой попыткой) и пауза между проходами
+CRAWLER_WORKERS = 4
+CRAWLER_MAX_ATTEMPTS = 5
+CRAWLER_RETRY_SECONDS = 5 * 60
+CRAWLER_PASS_INTERVAL_DAYS = 7
+
+# Пакетное обновление давно не проверявшихся на сайте цитат: потоки и размер пачки,
+# записываемой одной транзакцией
+QUOTE_REFRESH_WORKERS = 4
+QUOTE_REFRESH_BATCH_SIZE = 100
+
 LENGTH_TEXT_OF_SMALL_QUOTE = 200
 
 ITEMS_PER_PAGE = 10
@@ -5,27 +5,23 @@ __author__ = "ipetrash"
 
 
 import datetime as dt
-import time
-from random import randint
 
-from bot.db_utils import update_quote
-from bot.db import Quote, fn
+from bot.quote_refresher import QuoteRefresher
+from common import log
+from config import (
+    BASH_IM_HOST_INTERVAL_MS,
+    QUOTE_REFRESH_WORKERS,
+    QUOTE_REFRESH_BATCH_SIZE,
+)
+from third_party import bash_im
 
 
-i = 0
-for quote in (
-    Quote.select()
-    .where(Quote.modification_date <= dt.date(2020, 9, 6))
-    .order_by(fn.Random())
-):
-    i += 1
-    while True:
-        try:
-            print(i, quote.id)
-            update_quote(quote.id)
-            break
-        except:
-            time.sleep(60)
+bash_im.set_host_interval(BASH_IM_HOST_INTERVAL_MS)
 
-    seconds = randint(20, 60)
-    time.sleep(seconds)
+refresher = QuoteRefresher(
+    workers=QUOTE_REFRESH_WORKERS,
+    batch_size=QUOTE_REFRESH_BATCH_SIZE,
+    log=log,
+)
+stats = refresher.run(refresh_date=dt.date(2020, 9, 6))
+print(stats)
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+"""
+Локальная замена bash.im для проверки и замеров парсеров без доступа к сайту.
+Отдает страницы из etc/fixtures/bash_im (см. etc/bench_bash_im_parsers.py):
+    /                 - последняя страница архива
+    /index/N          - страница архива, для незаписанных номеров записанная страница
+                        с перенумерованными цитатами, чтобы на каждой странице были свои цитаты
+    /random           - случайные цитаты, каждый раз с новыми номерами
+    /quote/N          - цитата, для незаписанных номеров шаблон записанной цитаты
+    /strip/X          - страница комикса
+    /img/strips/X.png - картинка комикса (сгенерированная)
+Задержка ответов и доля ответов с ошибкой настраиваются.
+
+Запуск: python etc/bash_im_server.py --port 8080 --latency-ms 100 --error-rate 0.05
+Для бота: bash_im.URL_BASE = "http://127.0.0.1:8080"
+"""
+
+
+import argparse
+import hashlib
+import itertools
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+
+DIR = Path(__file__).resolve().parent
+DIR_FIXTURES = DIR / "fixtures" / "bash_im"
+
+# Сдвиг номеров цитат на перенумерованных страницах, больше номеров настоящих цитат
+QUOTE_ID_OFFSET = 10_000_000
+
+PATTERN_QUOTE_ID = re.compile(r'(data-quote="|/quote/|>#)(\d+)')
+PATTERN_PAGER = re.compile(r'(class="pager__input"[^>]*max=")\d+("[^>]*value=")\d+')
+
+
+def get_png(width: int = 1, height: int = 1, seed: str = "") -> bytes:
+    """
+    Простая картинка PNG одного цвета, цвет зависит от seed
+    """
+
+    def _chunk(name: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + name
+            + data
+            + struct.pack(">I", zlib.crc32(name + data) & 0xFFFFFFFF)
+        )
+
+    color = hashlib.md5(seed.encode("utf-8")).digest()[:3]
+    raw = b"".join(b"\x00" + color * width for _ in range(height))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + _chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + _chunk(b"IDAT", zlib.compress(raw))
+        + _chunk(b"IEND", b"")
+    )
+
+
+def renumber_quotes(content: str, offset: int) -> str:
+    return PATTERN_QUOTE_ID.sub(
+        lambda m: f"{m.group(1)}{int(m.group(2)) + offset}", content
+    )
+
+
+class Fixtures:
+    def __init__(self, dir_name: Path = DIR_FIXTURES, total_pages: int = None):
+        self.pages: Dict[str, str] = {
+            path.stem: path.read_text("utf-8")
+            for path in sorted(dir_name.glob("*.html"))
+        }
+
+        self.index_pages: Dict[int, str] = {
+            int(name.split("_")[1]): content
+            for name, content in self.pages.items()
+            if name.startswith("index_")
+        }
+        self.quote_pages: Dict[int, str] = {
+            int(name.split("_")[1]): content
+            for name, content in self.pages.items()
+            if name.startswith("quote_")
+        }
+        self.strip_page = next(
+            content for name, content in self.pages.items() if name.startswith("strip_")
+        )
+
+        self.last_recorded_page = max(self.index_pages)
+        self.total_pages = total_pages or self.last_recorded_page
+
+        self._random_counter = itertools.count(1)
+
+    def _set_total_pages(self, content: str, page: int) -> str:
+        return PATTERN_PAGER.sub(
+            lambda m: f"{m.group(1)}{self.total_pages}{m.group(2)}{page}", content
+        )
+
+    def get_index(self, page: int = None) -> Optional[str]:
+        if page is None:
+            page = self.total_pages
+
+        if not 1 <= page <= self.total_pages:
+            return
+
+        content = self.index_pages.get(page)
+        if content is None:
+            recorded_pages = sorted(self.index_pages)
+            content = self.index_pages[recorded_pages[page % len(recorded_pages)]]
+            content = renumber_quotes(content, QUOTE_ID_OFFSET * page)
+
+        return self._set_total_pages(content, page)
+
+    def get_random(self) -> str:
+        offset = QUOTE_ID_OFFSET * (self.total_pages + next(self._random_counter))
+        return renumber_quotes(self.pages["random"], offset)
+
+    def get_quote(self, quote_id: int) -> str:
+        content = self.quote_pages.get(quote_id)
+        if content is not None:
+            return content
+
+        template_id, content = next(iter(self.quote_pages.items()))
+        return content.replace(str(template_id), str(quote_id))
+
+    def get_strip(self, strip_id: str) -> str:
+        return re.sub(r"/img/strips/[^\"]+\.png", f"/img/strips/{strip_id}.png", self.strip_page)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    server: "BashImServer"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _route(self) -> Tuple[int, str, bytes]:
+        fixtures = self.server.fixtures
+        path = self.path.split("?")[0].rstrip("/")
+
+        content = None
+        content_type = "text/html; charset=utf-8"
+
+        if not path:
+            content = fixtures.get_index()
+
+        elif m := re.fullmatch(r"/index/(\d+)", path):
+            content = fixtures.get_index(int(m.group(1)))
+
+        elif path == "/random":
+            content = fixtures.get_random()
+
+        elif m := re.fullmatch(r"/quote/(\d+)", path):
+            content = fixtures.get_quote(int(m.group(1)))
+
+        elif m := re.fullmatch(r"/strip/([\w-]+)", path):
+            content = fixtures.get_strip(m.group(1))
+
+        elif re.fullmatch(r"/img/[\w/.-]+\.png", path):
+            return 200, "image/png", get_png(64, 64, seed=path)
+
+        if content is None:
+            return 404, content_type, b"Not Found"
+
+        return 200, content_type, content.encode("utf-8")
+
+    def do_GET(self):
+        self.server.count_request()
+
+        latency = self.server.get_latency()
+        if latency:
+            time.sleep(latency)
+
+        if self.server.is_error():
+            self.send_response(self.server.error_status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        status, content_type, body = self._route()
+
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if status == 200 and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if status == 200:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class BashImServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency_ms: int = 0,
+        jitter_ms: int = 0,
+        error_rate: float = 0.0,
+        error_status: int = 503,
+        total_pages: int = None,
+        verbose: bool = False,
+    ):
+        """
+        port: 0 - любой свободный порт
+        latency_ms, jitter_ms: задержка ответа latency_ms ± jitter_ms
+        error_rate: доля ответов со статусом error_status
+        total_pages: количество страниц архива, по умолчанию - последняя записанная
+        """
+
+        super().__init__((host, port), RequestHandler)
+
+        self.fixtures = Fixtures(total_pages=total_pages)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.verbose = verbose
+
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self.total_requests = 0
+
+        self._thread: threading.Thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count_request(self):
+        with self._lock:
+            self.total_requests += 1
+
+    def get_latency(self) -> float:
+        with self._lock:
+            jitter = self._random.uniform(-self.jitter_ms, self.jitter_ms)
+        return max(self.latency_ms + jitter, 0) / 1000
+
+    def is_error(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def start(self) -> str:
+        """
+        Запуск в фоновом потоке, вернет адрес сервера
+        """
+
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local bash.im stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency-ms", type=int, default=0)
+    parser.add_argument("--jitter-ms", type=int, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--total-pages", type=int)
+    args = parser.parse_args()
+
+    server = BashImServer(
+        host=args.host,
+        port=args.port,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        total_pages=args.total_pages,
+        verbose=True,
+    )
+    print(f"Serving on {server.url}, total pages: {server.fixtures.total_pages}")
+    server.serve_forever()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+"""
+Замер скачивания цитат от запроса до записи в базу: ArchiveCrawler обходит страницы
+локальной замены bash.im (etc/bash_im_server.py), цитаты пишутся во временную базу,
+комиксы скачиваются во временную папку.
+
+Запуск: python etc/bench_bash_im_ingest.py --pages 100 --workers 4 --latency-ms 50
+"""
+
+
+import argparse
+import logging
+import sys
+import tempfile
+import time
+from pathlib import Path
+from threading import Lock
+from typing import List
+
+DIR = Path(__file__).resolve().parent
+sys.path.append(str(DIR.parent))
+
+parser = argparse.ArgumentParser(description="End-to-end bash.im ingestion benchmark")
+parser.add_argument("--pages", type=int, default=100)
+parser.add_argument("--workers", type=int, default=4)
+parser.add_argument("--host-interval-ms", type=int, default=0)
+parser.add_argument("--latency-ms", type=int, default=50)
+parser.add_argument("--jitter-ms", type=int, default=0)
+parser.add_argument("--error-rate", type=float, default=0.0)
+parser.add_argument("--parser", help="Name of the parser backend")
+args = parser.parse_args()
+
+# Замер пишет во временную базу, а не в базу бота
+DIR_TEMP = Path(tempfile.mkdtemp(prefix="bench_bash_im_ingest_"))
+
+import config
+config.DB_FILE_NAME = str(DIR_TEMP / "database.sqlite")
+config.DB_FILE_NAME_ERROR = str(DIR_TEMP / "database_error.sqlite")
+
+from bash_im_server import BashImServer
+from bot import db
+from bot.comics_downloader import comics_downloader
+from bot.crawler import ArchiveCrawler
+from third_party import bash_im
+
+
+server = BashImServer(
+    latency_ms=args.latency_ms,
+    jitter_ms=args.jitter_ms,
+    error_rate=args.error_rate,
+    total_pages=args.pages,
+)
+bash_im.URL_BASE = server.start()
+
+if args.parser:
+    bash_im.set_parser_backend(args.parser)
+
+bash_im.set_host_interval(args.host_interval_ms)
+
+dir_comics = DIR_TEMP / "comics"
+
+lock = Lock()
+total_quotes = 0
+db_elapsed = 0.0
+
+
+def save_quotes(quotes: List[bash_im.Quote], dir_comics: Path) -> List[int]:
+    global total_quotes, db_elapsed
+
+    t = time.perf_counter()
+    new_ids = db.Quote.bulk_get_from(quotes)
+    elapsed = time.perf_counter() - t
+
+    for quote in quotes:
+        if quote.comics_urls:
+            comics_downloader.submit(quote, dir_comics)
+
+    with lock:
+        total_quotes += len(quotes)
+        db_elapsed += elapsed
+
+    return new_ids
+
+
+crawler = ArchiveCrawler(
+    save_quotes=save_quotes,
+    workers=args.workers,
+    max_attempts=3,
+    retry_seconds=1,
+    log=logging.getLogger(__name__),
+)
+
+print(
+    f"Server: {server.url}, pages: {args.pages}, workers: {args.workers}, "
+    f"latency: {args.latency_ms} ms, error rate: {args.error_rate}, "
+    f"parser: {bash_im.parser_backend.name}"
+)
+print()
+
+t = time.perf_counter()
+crawler.add_pages(args.pages)
+crawler.run(dir_comics)
+elapsed = time.perf_counter() - t
+
+t_comics = time.perf_counter()
+comics_downloader.join()
+comics_files = comics_downloader.total_files
+comics_elapsed = elapsed + time.perf_counter() - t_comics
+
+print(f"Pages:  {crawler.pages_done} done, {crawler.pages_failed} failed, {elapsed:.2f} s")
+print(f"        {crawler.pages_done / elapsed:10.1f} pages/s")
+print(f"Quotes: {total_quotes} parsed, {crawler.new_quotes} new")
+print(f"        {total_quotes / elapsed:10.1f} quotes/s")
+# Время суммируется по всем потокам и включает ожидание блокировки записи
+print(f"DB:     {db_elapsed:.2f} s in Quote.bulk_get_from (sum over workers)")
+print(f"        {crawler.new_quotes / db_elapsed if db_elapsed else 0:10.1f} inserted quotes/s")
+print(f"Comics: {comics_files} files, {comics_elapsed:.2f} s")
+print(f"HTTP:   {server.total_requests} requests")
+
+server.stop()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "ipetrash"
+
+
+"""
+Сравнение способов разбора страниц bash.im на страницах из etc/fixtures/bash_im:
+скорость (цитат в секунду) и одинаковость результатов.
+
+NOTE: Страницы не сохранены с сайта, а восстановлены по его разметке (главная, архив,
+случайные, цитата, комикс), т.к. bash.im недоступен. При доступе к сайту их нужно
+заменить на сохраненные страницы с теми же именами файлов и повторить сравнение
+"""
+
+
+import sys
+import time
+from pathlib import Path
+
+DIR = Path(__file__).resolve().parent
+sys.path.append(str(DIR.parent))
+
+from third_party import bash_im
+
+
+DIR_FIXTURES = DIR / "fixtures" / "bash_im"
+REPEATS = 20
+
+
+def parse_all(backend: bash_im.ParserBackend, pages: dict) -> dict:
+    result = dict()
+    for name, content in pages.items():
+        if name.startswith("strip_"):
+            result[name] = backend.get_comics_image_src(content)
+        elif name.startswith("index_"):
+            result[name] = (
+                backend.get_total_pages(content),
+                backend.parse_quotes(content),
+            )
+        else:
+            result[name] = backend.parse_quotes(content)
+
+    return result
+
+
+pages = {
+    path.stem: path.read_bytes()
+    for path in sorted(DIR_FIXTURES.glob("*.html"))
+}
+backends = bash_im.get_available_parser_backends()
+print(f"Pages: {len(pages)}, backends: {', '.join(backend.name for backend in backends)}")
+print()
+
+expected = parse_all(bash_im.BS4_HTML_PARSER, pages)
+total_quotes = sum(
+    len(value[1] if isinstance(value, tuple) else value)
+    for name, value in expected.items()
+    if not name.startswith("strip_")
+)
+assert total_quotes > 0
+
+for backend in backends:
+    result = parse_all(backend, pages)
+    assert result == expected, f"Результат {backend.name!r} отличается от {bash_im.BS4_HTML_PARSER.name!r}"
+
+    t = time.perf_counter()
+    for _ in range(REPEATS):
+        for content in pages.values():
+            backend.parse_quotes(content)
+    elapsed = time.perf_counter() - t
+
+    quotes_per_second = total_quotes * REPEATS / elapsed
+    print(f"{backend.name:20} {quotes_per_second:10.0f} quotes/s")
+
+print()
+print(f"All backends produce the same {total_quotes} quotes")
@@ -13,9 +13,13 @@ from telegram.ext import Updater, Defaults
 
 import common
 from bot import commands, db
-from config import TOKEN, DIR_COMICS
+from config import (
+    TOKEN, DIR_COMICS, DIR_HTTP_CACHE, HTTP_CACHE_TTL, HTTP_CACHE_MAX_SIZE, HTTP_CACHE_MAX_AGE,
+    BASH_IM_HOST_INTERVAL_MS,
+)
 from common import log, log_backup
-from bot.db_utils import do_backup
+from bot.db_utils import do_backup, do_reconcile_stats
+from third_party import bash_im
 from bot.parsers import (
     download_random_quotes,
     download_main_page_quotes,
@@ -46,16 +50,29 @@ def main():
     updater.start_polling()
     updater.idle()
 
+    # Запись накопленных в буферах запросов и времени активности
+    db.request_buffer.flush_all()
+    db.last_activity_buffer.flush_all()
+
     log.debug("Finish")
 
 
 if __name__ == "__main__":
+    bash_im.set_http_cache(
+        DIR_HTTP_CACHE,
+        HTTP_CACHE_TTL,
+        max_size=HTTP_CACHE_MAX_SIZE,
+        max_age=HTTP_CACHE_MAX_AGE,
+    )
+    bash_im.set_host_interval(BASH_IM_HOST_INTERVAL_MS)
+
     # TODO: Вернуть, если https://bash.im станет доступен
     # Thread(target=download_main_page_quotes, args=[log, DIR_COMICS]).start()
     # Thread(target=download_seq_page_quotes, args=[log, DIR_COMICS]).start()
     # Thread(target=download_random_quotes, args=[log, DIR_COMICS]).start()
     # Thread(target=run_parser_health_check, args=[log]).start()
     Thread(target=do_backup, args=[log_backup]).start()
+    Thread(target=do_reconcile_stats, args=[log]).start()
 
     while True:
         try:
@@ -4,18 +4,30 @@
 __author__ = 'ipetrash'
 
 
+import abc
 import datetime as DT
+import hashlib
+import json
+import os
+import threading
+import time
 import traceback
 import re
 import shutil
 
 from dataclasses import dataclass, field
 from pathlib import Path
-from urllib.parse import urljoin
-from typing import List, Union, Optional
+from urllib.parse import urljoin, urlparse
+from typing import List, Union, Optional, Any, Dict, Tuple, Iterator
+from collections import OrderedDict
 
 import requests
-from bs4 import BeautifulSoup, Tag
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, Tag, Comment
+from bs4.builder import builder_registry
 
 
 def parse(obj) -> BeautifulSoup:
@@ -35,6 +47,10 @@ def shorten(text: str, length=30) -> str:
 def get_plaintext(element: Tag) -> str:
     items = []
     for elem in element.descendants:
+        # Комментарии html не являются текстом цитаты
+        if isinstance(elem, Comment):
+            continue
+
         if isinstance(elem, str):
             items.append(elem.strip())
         elif elem.name in ['br', 'p']:
@@ -49,9 +65,349 @@ DATE_FORMAT_QUOTE = '%d.%m.%Y'
 URL_BASE = 'https://bash.im'
 USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:91.0) Gecko/20100101 Firefox/91.0'
 
+
+class HttpCache:
+    """
+    Кэш ответов на диске. Пока ответ свежий (моложе TTL его вида адреса), он возвращается
+    без запроса к серверу, иначе проверяется условным запросом с ETag/Last-Modified.
+    Раз в PRUNE_INTERVAL секунд при записи удаляются ответы старше max_age секунд,
+    а затем самые старые, пока кэш больше max_size байт
+    """
+
+    PRUNE_INTERVAL = 10 * 60
+
+    # Виды адресов bash.im по пути
+    URL_CLASSES = [
+        ('random', r'^/random'),
+        ('quote', r'^/quote/\d+'),
+        ('index', r'^/index/\d+'),
+        ('strip', r'^/strip/'),
+        ('image', r'^/img/'),
+        ('main', r'^/?$'),
+    ]
+
+    def __init__(
+            self,
+            dir_name: Union[str, Path],
+            ttl_by_url_class: Dict[str, Optional[int]],
+            default_ttl: Optional[int] = 0,
+            max_size: Optional[int] = None,
+            max_age: Optional[int] = None,
+    ):
+        """
+        ttl_by_url_class: время жизни в секундах по видам адресов,
+        0 - всегда проверять на сервере, None - не кэшировать
+        max_size, max_age: ограничения кэша в байтах и секундах, None - без ограничения
+        """
+
+        self.dir_name = Path(dir_name)
+        self.ttl_by_url_class = ttl_by_url_class
+        self.default_ttl = default_ttl
+        self.max_size = max_size
+        self.max_age = max_age
+
+        self._prune_lock = threading.Lock()
+        self._last_prune_time = 0.0
+
+        # Ответы из кэша без запроса, подтвержденные сервером через 304 и скачанные заново
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def get_url_class(self, url: str) -> Optional[str]:
+        path = urlparse(url).path
+        for name, pattern in self.URL_CLASSES:
+            if re.search(pattern, path):
+                return name
+
+    def get_ttl(self, url: str) -> Optional[int]:
+        url_class = self.get_url_class(url)
+        return self.ttl_by_url_class.get(url_class, self.default_ttl)
+
+    def _get_file_names(self, url: str) -> Tuple[Path, Path]:
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return self.dir_name / f'{key}.json', self.dir_name / f'{key}.body'
+
+    def load(self, url: str) -> Optional[Tuple[dict, bytes]]:
+        meta_file_name, body_file_name = self._get_file_names(url)
+        try:
+            meta = json.loads(meta_file_name.read_text('utf-8'))
+            body = body_file_name.read_bytes()
+        except (OSError, ValueError):
+            return
+
+        if meta.get('url') != url:
+            return
+
+        return meta, body
+
+    def save(self, url: str, headers: CaseInsensitiveDict, body: bytes, meta: dict = None):
+        self.dir_name.mkdir(parents=True, exist_ok=True)
+        meta_file_name, body_file_name = self._get_file_names(url)
+
+        meta = dict(meta or dict())
+        meta.update(
+            url=url,
+            fetched_at=time.time(),
+            headers=dict(headers),
+        )
+
+        # Валидаторы из нового ответа, иначе остаются прежние
+        if headers.get('ETag'):
+            meta['etag'] = headers['ETag']
+        if headers.get('Last-Modified'):
+            meta['last_modified'] = headers['Last-Modified']
+
+        write_bytes_atomic(body_file_name, body)
+        write_bytes_atomic(meta_file_name, json.dumps(meta, ensure_ascii=False).encode('utf-8'))
+
+        if time.monotonic() - self._last_prune_time >= self.PRUNE_INTERVAL:
+            self.prune()
+
+    def prune(self) -> int:
+        """
+        Удаление старых ответов по max_age и max_size. Вернет количество удаленных ответов
+        """
+
+        if self.max_size is None and self.max_age is None:
+            return 0
+
+        # Очистку выполняет один поток, остальные ее пропускают
+        if not self._prune_lock.acquire(blocking=False):
+            return 0
+
+        try:
+            self._last_prune_time = time.monotonic()
+
+            # Время записи ответа - время изменения его .json, размер - сумма обоих файлов
+            mtime_by_key: Dict[str, float] = dict()
+            size_by_key: Dict[str, int] = dict()
+            meta_keys = set()
+            try:
+                with os.scandir(self.dir_name) as it:
+                    for entry in it:
+                        key, ext = os.path.splitext(entry.name)
+                        if ext not in ('.json', '.body'):
+                            continue
+
+                        stat = entry.stat()
+                        size_by_key[key] = size_by_key.get(key, 0) + stat.st_size
+                        if ext == '.json' or key not in mtime_by_key:
+                            mtime_by_key[key] = stat.st_mtime
+                        if ext == '.json':
+                            meta_keys.add(key)
+            except FileNotFoundError:
+                return 0
+
+            now = time.time()
+            total_size = sum(size_by_key.values())
+
+            removed = 0
+            for key in sorted(size_by_key, key=mtime_by_key.get):
+                age = now - mtime_by_key[key]
+                is_expired = self.max_age is not None and age > self.max_age
+                is_oversize = self.max_size is not None and total_size > self.max_size
+
+                # Тело без .json - недописанный или брошенный ответ
+                is_orphan = key not in meta_keys and age > self.PRUNE_INTERVAL
+
+                if not is_expired and not is_oversize and not is_orphan:
+                    continue
+
+                for ext in ('.json', '.body'):
+                    try:
+                        os.remove(self.dir_name / f'{key}{ext}')
+                    except FileNotFoundError:
+                        pass
+
+                total_size -= size_by_key[key]
+                removed += 1
+
+            return removed
+
+        finally:
+            self._prune_lock.release()
+
+    @staticmethod
+    def build_response(
+            request: requests.PreparedRequest,
+            meta: dict,
+            body: bytes,
+            adapter: HTTPAdapter,
+    ) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.headers = CaseInsensitiveDict(meta['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.connection = adapter
+        response._content = body
+        response._content_consumed = True
+        response.from_cache = True
+        return response
+
+
+class HostRateLimiter:
+    """
+    Ограничение частоты запросов: к одному хосту не чаще, чем раз в interval_ms миллисекунд
+    """
+
+    def __init__(self, interval_ms: int):
+        self.interval = interval_ms / 1000
+        self._lock = threading.Lock()
+        self._next_time_by_host: Dict[str, float] = dict()
+
+    def wait(self, url: str):
+        host = urlparse(url).netloc
+
+        # Каждый поток резервирует себе очередное время и ждет его без блокировки
+        with self._lock:
+            now = time.monotonic()
+            next_time = max(now, self._next_time_by_host.get(host, now))
+            self._next_time_by_host[host] = next_time + self.interval
+
+        delay = next_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+# Общее ограничение для всех запросов session к серверу, ответы из кэша его не ждут
+rate_limiter = HostRateLimiter(interval_ms=0)
+
+
+class CachingHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter с необязательным HttpCache для GET-запросов и общим rate_limiter
+    """
+
+    def __init__(self, *args, http_cache: HttpCache = None, **kwargs):
+        self.http_cache = http_cache
+        super().__init__(*args, **kwargs)
+
+    def _send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        rate_limiter.wait(request.url)
+        return super().send(request, **kwargs)
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        cache = self.http_cache
+        if not cache or request.method != 'GET':
+            return self._send(request, **kwargs)
+
+        ttl = cache.get_ttl(request.url)
+        if ttl is None:
+            return self._send(request, **kwargs)
+
+        # Cache-Control: no-cache в запросе - свежесть не учитывается, только условный запрос
+        force_revalidate = 'no-cache' in request.headers.get('Cache-Control', '')
+
+        cached = cache.load(request.url)
+        if cached:
+            meta, body = cached
+            if not force_revalidate and time.time() - meta['fetched_at'] < ttl:
+                cache.hits += 1
+                return cache.build_response(request, meta, body, self)
+
+            if meta.get('etag'):
+                request.headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                request.headers['If-Modified-Since'] = meta['last_modified']
+
+        response = self._send(request, **kwargs)
+
+        if cached and response.status_code == 304:
+            cache.revalidated += 1
+            response.close()
+
+            headers = CaseInsensitiveDict(meta['headers'])
+            headers.update(response.headers)
+            cache.save(request.url, headers, body, meta)
+            return cache.build_response(request, meta, body, self)
+
+        if response.status_code == 200:
+            cache.misses += 1
+            cache.save(request.url, response.headers, response.content)
+
+        return response
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['http_cache'] = self.http_cache
+        return state
+
+
 session = requests.session()
 session.headers['User-Agent'] = USER_AGENT
 
+# Пул соединений на несколько потоков и повтор запросов при временных ошибках сервера
+adapter = CachingHTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+    ),
+)
+session.mount('https://', adapter)
+session.mount('http://', adapter)
+
+
+def set_http_cache(
+        dir_name: Union[str, Path],
+        ttl_by_url_class: Dict[str, Optional[int]],
+        max_size: Optional[int] = None,
+        max_age: Optional[int] = None,
+):
+    """
+    Включение кэша ответов для session, см. HttpCache
+    """
+
+    adapter.http_cache = HttpCache(dir_name, ttl_by_url_class, max_size=max_size, max_age=max_age)
+
+
+def set_host_interval(interval_ms: int):
+    """
+    Интервал между запросами session к одному хосту, общий для всех потоков
+    """
+
+    rate_limiter.interval = interval_ms / 1000
+
+
+def get_comics_id(url: str) -> str:
+    return url.rstrip('/').split('/')[-1]
+
+
+def get_comics_file_name(quote_id: int, url: str) -> str:
+    return f'quote{quote_id}_{get_comics_id(url)}.png'
+
+
+def get_comics_image_url(url: str) -> str:
+    # Страница комикса
+    rs = session.get(url)
+    rs.raise_for_status()
+
+    url_src = parser_backend.get_comics_image_src(rs.content)
+    return urljoin(URL_BASE, url_src)
+
+
+def write_bytes_atomic(file_name: Path, data: bytes):
+    # Запись во временный файл и замена, чтобы не оставалось недописанных файлов
+    tmp_file_name = file_name.with_name(f'{file_name.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        tmp_file_name.write_bytes(data)
+        os.replace(tmp_file_name, file_name)
+    finally:
+        tmp_file_name.unlink(missing_ok=True)
+
+
+def download_comics_file(url_img: str, file_name: Path):
+    # Картинка комикса
+    rs = session.get(url_img)
+    rs.raise_for_status()
+    write_bytes_atomic(file_name, rs.content)
+
 
 @dataclass
 class Quote:
@@ -86,24 +442,12 @@ class Quote:
             try:
                 dir_name.mkdir(parents=True, exist_ok=True)
 
-                comics_id = url.rstrip('/').split('/')[-1]
-                file_name = dir_name / f'quote{self.id}_{comics_id}.png'
+                file_name = dir_name / get_comics_file_name(self.id, url)
 
                 # Если нет файла, скачиваем
                 if not file_name.exists():
-                    # Страница комикса
-                    rs = session.get(url)
-                    rs.raise_for_status()
-                    root = parse(rs.content)
-
-                    img_el = root.select_one('.quote__img')
-                    url_src = img_el.get('src') or img_el.get('data-src')
-                    url_img = urljoin(URL_BASE, url_src)
-
-                    # Картинка комикса
-                    rs = session.get(url_img)
-                    rs.raise_for_status()
-                    file_name.write_bytes(rs.content)
+                    url_img = get_comics_image_url(url)
+                    download_comics_file(url_img, file_name)
 
                 files.append(str(file_name.resolve()))
 
@@ -117,124 +461,469 @@ class Quote:
         return files
 
     @staticmethod
-    def parse_from(url__id__el: Union[str, int, Tag]) -> Optional['Quote']:
+    def parse_from(url__id__el: Union[str, int, Tag], force_revalidate=False) -> Optional['Quote']:
+        """
+        force_revalidate: не брать свежий ответ из кэша, а проверить его на сервере
+        """
+
         if isinstance(url__id__el, int):
             url__id__el = f'{URL_BASE}/quote/{url__id__el}'
 
         if isinstance(url__id__el, str):
             url = url__id__el
 
-            rs = session.get(url)
+            headers = {'Cache-Control': 'no-cache'} if force_revalidate else None
+            rs = session.get(url, headers=headers)
             rs.raise_for_status()
 
             # Если был редирект на главную страницу, значит нет цитаты с указанным id
             if rs.url.rstrip('/') == URL_BASE:
                 return
 
-            root = parse(rs.content)
-            quote_el = root.select_one('article.quote')
+            quotes = parse_response_quotes(rs)
+            return quotes[0] if quotes else None
 
-        else:
-            quote_el = url__id__el
+        return BS4_HTML_PARSER.parse_quote_el(url__id__el)
 
-        comics_urls = []
-        strips_el = quote_el.select_one('.quote__strips')
-        if strips_el:
-            comics_urls += [
-                urljoin(URL_BASE, a['href']) for a in strips_el.select('.quote__strips_link')
-            ]
+    def __str__(self):
+        return f'{self.__class__.__name__}(id={self.id}, url={self.url}, ' \
+               f'text({len(self.text)})={shorten(self.text)!r}, ' \
+               f'date={self.date_str}, rating={self.rating}, comics_urls={self.comics_urls})'
 
-            # Удаление тега, чтобы при получении текста цитаты не было в нем лишний текст
-            strips_el.decompose()
 
-        href = quote_el.select_one('.quote__header_permalink')['href']
-        url = urljoin(URL_BASE, href)
+def create_quote(
+        href: str,
+        text: str,
+        rating_text: str,
+        date_text: str,
+        comics_hrefs: List[str],
+) -> Quote:
+    """
+    Создание цитаты из извлеченных из html значений, общее для всех способов разбора
+    """
+
+    url = urljoin(URL_BASE, href)
+    comics_urls = [urljoin(URL_BASE, href) for href in comics_hrefs]
 
-        quote_text = get_plaintext(
-            quote_el.select_one('.quote__body')
-        )
+    # У некоторых цитат не указан рейтинг, выглядит как: ...
+    # Например, в https://bash.im/quote/416789
+    try:
+        rating = int(rating_text)
+    except:
+        rating = 0
 
-        # У некоторых цитат не указан рейтинг, выглядит как: ...
-        # Например, в https://bash.im/quote/416789
-        try:
-            rating = int(quote_el.select_one('.quote__total').get_text())
-        except:
-            rating = 0
+    # Example: "07.12.2011 в 11:11"
+    m = re.search(r'(\d{2})\.(\d{2})\.(\d{4})', date_text)
+    day, month, year = map(int, m.groups())
+    date = DT.date(year, month, day)
 
-        # Example: "07.12.2011 в 11:11"
-        m = re.search(r'(\d{2})\.(\d{2})\.(\d{4})', quote_el.select_one('.quote__header_date').get_text())
-        day, month, year = map(int, m.groups())
-        date = DT.date(year, month, day)
+    return Quote(url, text, date, rating, comics_urls)
 
-        return Quote(url, quote_text, date, rating, comics_urls)
 
-    def __str__(self):
-        return f'{self.__class__.__name__}(id={self.id}, url={self.url}, ' \
-               f'text({len(self.text)})={shorten(self.text)!r}, ' \
-               f'date={self.date_str}, rating={self.rating}, comics_urls={self.comics_urls})'
+class ParserBackend(abc.ABC):
+    """
+    Способ разбора html страниц bash.im. Все способы должны возвращать одинаковые цитаты
+    """
 
+    name: str = None
 
-def get_random_quotes(logger=None) -> List[Quote]:
-    url = f'{URL_BASE}/random'
-    quotes = []
+    def is_available(self) -> bool:
+        return True
 
-    try:
-        rs = session.get(url)
-        rs.raise_for_status()
-        root = parse(rs.content)
+    @abc.abstractmethod
+    def get_quote_elements(self, content: Union[bytes, str]) -> List[Any]:
+        pass
+
+    @abc.abstractmethod
+    def parse_quote_el(self, quote_el: Any) -> Quote:
+        pass
+
+    @abc.abstractmethod
+    def get_total_pages(self, content: Union[bytes, str]) -> int:
+        pass
+
+    @abc.abstractmethod
+    def get_comics_image_src(self, content: Union[bytes, str]) -> str:
+        pass
+
+    def iter_quote_elements(self, content: Union[bytes, str]) -> Iterator[Any]:
+        quote_els = self.get_quote_elements(content)
+
+        # Из списка убираются ссылки на элементы, чтобы они освобождались по мере разбора
+        quote_els.reverse()
+        while quote_els:
+            yield quote_els.pop()
+
+    def free_quote_el(self, quote_el: Any):
+        """
+        Удаление уже разобранного элемента цитаты из дерева, чтобы освободить его память
+        """
 
-        for quote_el in root.select('article.quote'):
+        pass
+
+    def parse_quote(self, content: Union[bytes, str]) -> Optional[Quote]:
+        quote_els = self.get_quote_elements(content)
+        if not quote_els:
+            return
+
+        return self.parse_quote_el(quote_els[0])
+
+    def iter_quotes(self, content: Union[bytes, str], logger=None) -> Iterator[Quote]:
+        """
+        Цитаты по одной сразу после разбора, разобранные элементы удаляются из дерева
+        """
+
+        for quote_el in self.iter_quote_elements(content):
             try:
-                quotes.append(
-                    Quote.parse_from(quote_el)
-                )
+                quote = self.parse_quote_el(quote_el)
             except Exception:
                 msg = f'Error by parsing quote:\nquote_el:\n{quote_el}\n\n'
                 if logger:
                     logger.exception(msg)
                 else:
                     print(f'{msg}{traceback.format_exc()}')
+                continue
 
-    except Exception:
-        if logger:
-            logger.exception('')
-        else:
-            print(traceback.format_exc())
+            finally:
+                self.free_quote_el(quote_el)
+                del quote_el
 
-    return quotes
+            yield quote
 
+    def parse_quotes(self, content: Union[bytes, str], logger=None) -> List[Quote]:
+        return list(self.iter_quotes(content, logger))
 
-def get_page_quotes(page=None, logger=None) -> List[Quote]:
-    url = URL_BASE
-    if page:
-        url = urljoin(url, f'/index/{page}')
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.name!r})'
+
+
+class Bs4ParserBackend(ParserBackend):
+    def __init__(self, features: str):
+        self.features = features
+        self.name = f'bs4:{features}'
+
+    def is_available(self) -> bool:
+        return builder_registry.lookup(self.features) is not None
+
+    def parse(self, content: Union[bytes, str]) -> BeautifulSoup:
+        return BeautifulSoup(content, self.features)
+
+    def get_quote_elements(self, content: Union[bytes, str]) -> List[Tag]:
+        return self.parse(content).select('article.quote')
+
+    def parse_quote_el(self, quote_el: Tag) -> Quote:
+        comics_hrefs = []
+        strips_el = quote_el.select_one('.quote__strips')
+        if strips_el:
+            comics_hrefs = [a['href'] for a in strips_el.select('.quote__strips_link')]
+
+            # Удаление тега, чтобы при получении текста цитаты не было в нем лишний текст
+            strips_el.decompose()
+
+        rating_el = quote_el.select_one('.quote__total')
+
+        return create_quote(
+            href=quote_el.select_one('.quote__header_permalink')['href'],
+            text=get_plaintext(quote_el.select_one('.quote__body')),
+            rating_text=rating_el.get_text() if rating_el else '',
+            date_text=quote_el.select_one('.quote__header_date').get_text(),
+            comics_hrefs=comics_hrefs,
+        )
+
+    def free_quote_el(self, quote_el: Tag):
+        quote_el.decompose()
+
+    def get_total_pages(self, content: Union[bytes, str]) -> int:
+        return int(self.parse(content).select_one('.pager__input')['max'])
+
+    def get_comics_image_src(self, content: Union[bytes, str]) -> str:
+        img_el = self.parse(content).select_one('.quote__img')
+        return img_el.get('src') or img_el.get('data-src')
+
+
+def get_html_text(content: Union[bytes, str]) -> str:
+    # bash.im отдает страницы в utf-8
+    if isinstance(content, bytes):
+        content = content.decode('utf-8', errors='replace')
+    return content
+
+
+def get_xpath_by_class(class_name: str, tag: str = '*') -> str:
+    return f".//{tag}[contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')]"
+
+
+class LxmlParserBackend(ParserBackend):
+    name = 'lxml'
+
+    # Размер части страницы для iter_quote_elements
+    feed_size = 16 * 1024
+
+    def is_available(self) -> bool:
+        try:
+            import lxml.html
+            return True
+        except ImportError:
+            return False
+
+    def parse(self, content: Union[bytes, str]):
+        import lxml.html
+        return lxml.html.document_fromstring(get_html_text(content))
+
+    @staticmethod
+    def select_one(element, class_name: str, tag: str = '*'):
+        items = element.xpath(get_xpath_by_class(class_name, tag))
+        return items[0] if items else None
+
+    @staticmethod
+    def get_plaintext(element) -> str:
+        items = []
+
+        def _walk(el):
+            if el.text:
+                items.append(el.text.strip())
+
+            for child in el:
+                # У комментариев tag не строка, их текст пропускается
+                if isinstance(child.tag, str):
+                    if child.tag in ['br', 'p']:
+                        items.append('\n')
+                    _walk(child)
+
+                if child.tail:
+                    items.append(child.tail.strip())
+
+        _walk(element)
+        return ''.join(items).strip()
+
+    def get_quote_elements(self, content: Union[bytes, str]) -> List[Any]:
+        return self.parse(content).xpath(get_xpath_by_class('quote', 'article'))
+
+    def parse_quote_el(self, quote_el) -> Quote:
+        comics_hrefs = []
+        strips_el = self.select_one(quote_el, 'quote__strips')
+        if strips_el is not None:
+            comics_hrefs = [
+                a.get('href') for a in strips_el.xpath(get_xpath_by_class('quote__strips_link'))
+            ]
+
+            # Удаление тега с сохранением текста после него
+            strips_el.drop_tree()
+
+        rating_el = self.select_one(quote_el, 'quote__total')
+
+        return create_quote(
+            href=self.select_one(quote_el, 'quote__header_permalink').get('href'),
+            text=self.get_plaintext(self.select_one(quote_el, 'quote__body')),
+            rating_text=rating_el.text_content() if rating_el is not None else '',
+            date_text=self.select_one(quote_el, 'quote__header_date').text_content(),
+            comics_hrefs=comics_hrefs,
+        )
+
+    def iter_quote_elements(self, content: Union[bytes, str]) -> Iterator[Any]:
+        """
+        Разбор страницы частями: элементы цитат отдаются сразу после их закрытия,
+        поэтому все дерево страницы целиком в памяти не строится
+        """
+
+        import lxml.etree
+        import lxml.html
+
+        parser = lxml.etree.HTMLPullParser(events=('end',), tag='article')
+        parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup())
+
+        def _read_events() -> Iterator[Any]:
+            for _, el in parser.read_events():
+                if 'quote' in el.get('class', '').split():
+                    yield el
+
+        text = get_html_text(content)
+        for i in range(0, len(text), self.feed_size):
+            parser.feed(text[i:i + self.feed_size])
+            yield from _read_events()
+
+        parser.close()
+        yield from _read_events()
+
+    def free_quote_el(self, quote_el):
+        quote_el.drop_tree()
+
+    def get_total_pages(self, content: Union[bytes, str]) -> int:
+        return int(self.select_one(self.parse(content), 'pager__input').get('max'))
+
+    def get_comics_image_src(self, content: Union[bytes, str]) -> str:
+        img_el = self.select_one(self.parse(content), 'quote__img')
+        return img_el.get('src') or img_el.get('data-src')
+
+
+class SelectolaxParserBackend(ParserBackend):
+    name = 'selectolax'
+
+    def is_available(self) -> bool:
+        try:
+            from selectolax.lexbor import LexborHTMLParser
+            return True
+        except ImportError:
+            return False
+
+    def parse(self, content: Union[bytes, str]):
+        from selectolax.lexbor import LexborHTMLParser
+        return LexborHTMLParser(get_html_text(content))
+
+    @staticmethod
+    def get_plaintext(element) -> str:
+        items = []
+        for node in element.traverse(include_text=True):
+            if node.tag == '-text':
+                items.append(node.text(deep=False).strip())
+            elif node.tag in ['br', 'p']:
+                items.append('\n')
+        return ''.join(items).strip()
+
+    def get_quote_elements(self, content: Union[bytes, str]) -> List[Any]:
+        return self.parse(content).css('article.quote')
+
+    def parse_quote_el(self, quote_el) -> Quote:
+        comics_hrefs = []
+        strips_el = quote_el.css_first('.quote__strips')
+        if strips_el:
+            comics_hrefs = [a.attributes['href'] for a in strips_el.css('.quote__strips_link')]
+
+            # Удаление тега, чтобы при получении текста цитаты не было в нем лишний текст
+            strips_el.decompose()
+
+        rating_el = quote_el.css_first('.quote__total')
+
+        return create_quote(
+            href=quote_el.css_first('.quote__header_permalink').attributes['href'],
+            text=self.get_plaintext(quote_el.css_first('.quote__body')),
+            rating_text=rating_el.text() if rating_el else '',
+            date_text=quote_el.css_first('.quote__header_date').text(),
+            comics_hrefs=comics_hrefs,
+        )
+
+    def free_quote_el(self, quote_el):
+        quote_el.decompose()
+
+    def get_total_pages(self, content: Union[bytes, str]) -> int:
+        return int(self.parse(content).css_first('.pager__input').attributes['max'])
+
+    def get_comics_image_src(self, content: Union[bytes, str]) -> str:
+        img_el = self.parse(content).css_first('.quote__img')
+        return img_el.attributes.get('src') or img_el.attributes.get('data-src')
+
+
+BS4_HTML_PARSER = Bs4ParserBackend('html.parser')
+
+# По убыванию скорости
+PARSER_BACKENDS: List[ParserBackend] = [
+    SelectolaxParserBackend(),
+    LxmlParserBackend(),
+    Bs4ParserBackend('lxml'),
+    BS4_HTML_PARSER,
+]
+
+
+def get_available_parser_backends() -> List[ParserBackend]:
+    return [backend for backend in PARSER_BACKENDS if backend.is_available()]
+
+
+def get_parser_backend(name: str = None) -> ParserBackend:
+    """
+    Способ разбора по имени или самый быстрый из доступных
+    """
+
+    for backend in get_available_parser_backends():
+        if not name or backend.name == name:
+            return backend
+
+    raise Exception(f'Parser backend {name!r} is not available')
+
+
+def set_parser_backend(name: str = None):
+    global parser_backend
+    parser_backend = get_parser_backend(name)
+
+
+parser_backend: ParserBackend = get_parser_backend()
+
+
+# Разобранные цитаты страниц, полученных из кэша, чтобы не разбирать неизменные страницы повторно
+PARSED_QUOTES_CACHE_SIZE = 64
+parsed_quotes_cache: Dict[Tuple[str, bytes], List[Quote]] = OrderedDict()
+parsed_quotes_lock = threading.Lock()
+
+
+def iter_response_quotes(rs: requests.Response, logger=None) -> Iterator[Quote]:
+    if not getattr(rs, 'from_cache', False):
+        yield from parser_backend.iter_quotes(rs.content, logger)
+        return
+
+    key = parser_backend.name, hashlib.sha256(rs.content).digest()
+    with parsed_quotes_lock:
+        quotes = parsed_quotes_cache.get(key)
+        if quotes is not None:
+            parsed_quotes_cache.move_to_end(key)
+
+    if quotes is not None:
+        yield from quotes
+        return
 
     quotes = []
+    for quote in parser_backend.iter_quotes(rs.content, logger):
+        quotes.append(quote)
+        yield quote
+
+    # Запоминаются только полностью разобранные страницы
+    with parsed_quotes_lock:
+        parsed_quotes_cache[key] = quotes
+        if len(parsed_quotes_cache) > PARSED_QUOTES_CACHE_SIZE:
+            parsed_quotes_cache.popitem(last=False)
+
+
+def parse_response_quotes(rs: requests.Response, logger=None) -> List[Quote]:
+    return list(iter_response_quotes(rs, logger))
+
+
+def iter_url_quotes(url: str, logger=None, raise_error=False) -> Iterator[Quote]:
+    """
+    Цитаты страницы по одной по мере разбора. Страница скачивается
+    при получении первой цитаты, ошибки логируются, если не указан raise_error
+    """
 
     try:
         rs = session.get(url)
         rs.raise_for_status()
-        root = parse(rs.content)
 
-        for quote_el in root.select('article.quote'):
-            try:
-                quotes.append(
-                    Quote.parse_from(quote_el)
-                )
-            except Exception:
-                msg = f'Error by parsing quote:\nquote_el:\n{quote_el}\n\n'
-                if logger:
-                    logger.exception(msg)
-                else:
-                    print(f'{msg}{traceback.format_exc()}')
+        yield from iter_response_quotes(rs, logger)
 
     except Exception:
+        if raise_error:
+            raise
+
         if logger:
             logger.exception('')
         else:
             print(traceback.format_exc())
 
-    return quotes
+
+def iter_random_quotes(logger=None) -> Iterator[Quote]:
+    return iter_url_quotes(f'{URL_BASE}/random', logger)
+
+
+def get_random_quotes(logger=None) -> List[Quote]:
+    return list(iter_random_quotes(logger))
+
+
+def iter_page_quotes(page=None, logger=None, raise_error=False) -> Iterator[Quote]:
+    url = URL_BASE
+    if page:
+        url = urljoin(url, f'/index/{page}')
+
+    return iter_url_quotes(url, logger, raise_error)
+
+
+def get_page_quotes(page=None, logger=None, raise_error=False) -> List[Quote]:
+    return list(iter_page_quotes(page, logger, raise_error))
 
 
 def get_main_page_quotes(logger=None) -> List[Quote]:
@@ -244,9 +933,8 @@ def get_main_page_quotes(logger=None) -> List[Quote]:
 def get_total_pages() -> int:
     rs = session.get(URL_BASE)
     rs.raise_for_status()
-    root = parse(rs.content)
 
-    return int(root.select_one('.pager__input')['max'])
+    return parser_backend.get_total_pages(rs.content)
 
 
 def parser_health_check(raise_error=False) -> Optional[str]: